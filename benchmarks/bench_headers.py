@@ -0,0 +1,64 @@
+"""
+Parse synthetic documents with a growing number of headers, to check that
+``RstHeaderTree`` scales linearly with the document size.
+
+The previous scanner, which looked up every header offset with
+``text.find(raw)`` from the start of the document, is timed too (on the
+smaller documents only, as it's quadratic).
+
+Run it from the package directory::
+
+    $ python benchmarks/bench_headers.py
+
+"""
+from __future__ import print_function
+
+import timeit
+
+from _plugin import load
+
+headers = load('headers')
+
+SIZES = (2500, 5000, 10000, 20000)
+ADORNMENTS = ('=', '-', '~', '^')
+
+
+def document(count):
+    chunks = []
+    for i in range(count):
+        title = 'Section %d' % i
+        chunks.append('%s\n%s\n\nSome paragraph text for section %d.\n'
+                      % (title, ADORNMENTS[i % 4] * len(title), i))
+    return '\n'.join(chunks)
+
+
+def find_parse(text):
+    """the previous scanner: findall + text.find()"""
+    offsets = []
+    for over, title, under in headers.PATTERN_RE.findall(text):
+        raw = (over + '\n' if over else '') + title + '\n' + under
+        offsets.append(text.find(raw) - 1)
+    return offsets
+
+
+def best(func, number=3):
+    return min(timeit.repeat(func, number=1, repeat=number))
+
+
+def main():
+    print('%8s %10s %12s %14s' % ('headers', 'finditer', 'per header', 'text.find'))
+    for count in SIZES:
+        text = document(count)
+        tree = headers.RstHeaderTree(text)
+        assert len(tree.headers) == count
+        elapsed = best(lambda: headers.RstHeaderTree(text))
+        if count <= 5000:
+            previous = '%.3fs' % best(lambda: find_parse('\n' + text), 1)
+        else:
+            previous = '-'
+        print('%8d %9.3fs %10.2fus %14s' % (count, elapsed,
+                                            elapsed / count * 1e6, previous))
+
+
+if __name__ == '__main__':
+    main()
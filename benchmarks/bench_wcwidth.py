@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the throughput of ``wcwidth.wcswidth()`` against the previous
+implementation, which bisected the interval tables for every character.
+
+The page table is measured alone (no cache), then with the whole-string
+cache of ``wcswidth()``, emptied before each run: it only pays off when
+the same cells are measured again, as in the repeated cells.
+
+Run it from the package directory::
+
+    $ python benchmarks/bench_wcwidth.py
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'wcwidth'))
+import wcwidth   # NOQA
+from wcwidth.wcwidth import (_bisearch, _cache, _wcswidth,   # NOQA
+                             NONZERO_COMBINING, WIDE_EASTASIAN)
+
+
+def bisect_wcwidth(wc):
+    ucs = ord(wc)
+    if (0 == ucs or
+            0x034F == ucs or
+            0x200B <= ucs <= 0x200F or
+            0x2028 == ucs or
+            0x2029 == ucs or
+            0x202A <= ucs <= 0x202E or
+            0x2060 <= ucs <= 0x2063):
+        return 0
+    if ucs < 32 or 0x07F <= ucs < 0x0A0:
+        return -1
+    if _bisearch(ucs, NONZERO_COMBINING):
+        return -1
+    return 1 + _bisearch(ucs, WIDE_EASTASIAN)
+
+
+def bisect_wcswidth(pwcs, n=None):
+    end = len(pwcs) if n is None else n
+    width = 0
+    for char in pwcs[slice(0, end)]:
+        wcw = bisect_wcwidth(char)
+        if wcw < 0:
+            if _bisearch(ord(char), NONZERO_COMBINING):
+                continue
+            return -1
+        width += wcw
+    return width
+
+
+def check():
+    for ucs in range(0x110000):
+        if 0xd800 <= ucs <= 0xdfff:
+            continue
+        char = chr(ucs) if sys.version_info[0] > 2 else unichr(ucs)  # NOQA
+        assert wcwidth.wcwidth(char) == bisect_wcwidth(char), hex(ucs)
+        assert wcwidth.wcswidth(char) == bisect_wcswidth(char), hex(ucs)
+
+
+def cells(count, distinct=200):
+    samples = [u'Column', u'Put two (or more) spaces', u'café olé',
+               u'表格中的文字', u'한국어 텍스트', u'日本語のテキスト',
+               u'mixed 中文 text', u'égalité']
+    return [u'%s %d' % (samples[i % len(samples)], i % distinct)
+            for i in range(count)]
+
+
+def bench(func, fields, number=5, setup=None):
+    return min(timeit.repeat(lambda: [func(f) for f in fields],
+                             setup=setup or (lambda: None),
+                             number=1, repeat=number))
+
+
+def main():
+    check()
+    fields = cells(20000)
+    unique_fields = cells(20000, distinct=20000)
+    ascii_fields = [f for f in fields if all(ord(c) < 128 for c in f)]
+    for label, data in ((u'repeated', fields),
+                        (u'unique', unique_fields),
+                        (u'ascii', ascii_fields)):
+        before = bench(bisect_wcswidth, data)
+        table = bench(_wcswidth, data)
+        cached = bench(wcwidth.wcswidth, data, setup=_cache.clear)
+        print(u'%-8s %6d fields (%5d distinct)  bisect: %.4fs  '
+              u'page table: %.4fs (x%.1f)  cached: %.4fs (x%.1f)' % (
+                  label, len(data), len(set(data)), before, table,
+                  before / table, cached, before / cached))
+
+
+if __name__ == '__main__':
+    main()
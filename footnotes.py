@@ -3,50 +3,203 @@
 import sublime
 import sublime_plugin
 import re
+import threading
+from bisect import bisect_left, bisect_right
+try:
+    from .helpers import merge_changes
+except ValueError:
+    from helpers import merge_changes    # NOQA
 
 DEFINITION_KEY = 'footnote-definitions'
 REFERENCE_KEY = 'footnote-references'
-REFERENCE_REGEX = r'\[(\d+)\]\_'
-DEFINITION_REGEX = r"^\.\.\s\[(\d+)\]"
-
-
-def get_id(txt):
-    return re.findall(r'\d+', txt)[0]
+DIRTY_KEY = 'footnote-dirty'
+ORPHAN_KEY = 'footnote-orphans'
+# the labels docutils accepts: a number, an auto-number ``#`` with an
+# optional name, an auto-symbol ``*`` or a citation (a simple name)
+SIMPLENAME = r"(?:(?!_)\w)+(?:[-._+:](?:(?!_)\w)+)*"
+LABEL_REGEX = r"\d+|#(?:%s)?|\*|%s" % (SIMPLENAME, SIMPLENAME)
+REFERENCE_REGEX = r'\[(%s)\]\_' % LABEL_REGEX
+DEFINITION_REGEX = r"^\.\.[ \t]\[(%s)\]" % LABEL_REGEX
+FOOTNOTE_RE = re.compile(r"^\.\.[ \t]\[(?P<definition>%s)\]|\[(?P<reference>%s)\]\_"
+                         % (LABEL_REGEX, LABEL_REGEX), re.MULTILINE | re.UNICODE)
+
+# the symbols of auto-symbol footnotes, as docutils uses them
+SYMBOLS = [u'*', u'\u2020', u'\u2021', u'\u00a7', u'\u00b6', u'#',
+           u'\u2660', u'\u2665', u'\u2666', u'\u2663']
+
+# milliseconds without changes before updating the footnote regions
+UPDATE_DELAY = 250
+
+# orphan footnotes are underlined, where the API allows it
+ORPHAN_FLAGS = (getattr(sublime, 'DRAW_NO_FILL', 0) |
+                getattr(sublime, 'DRAW_NO_OUTLINE', 0) |
+                getattr(sublime, 'DRAW_SOLID_UNDERLINE', 0))
+
+# Sublime Text 4 reports what changed: only the lines touched are scanned
+INCREMENTAL = hasattr(sublime_plugin, 'TextChangeListener')
+
+
+def is_rst(view):
+    return view.score_selector(0, 'text.restructuredtext') > 0
+
+
+def scan_footnotes(text, offset=0):
+    """
+    finds the footnotes of a chunk of text made of whole lines,
+    in a single pass.
+
+    Returns a list of (region, label, in_definition) for the references
+    and a list of (region, label) for the definitions. in_definition
+    is true for a reference in the line of a definition.
+    offset is added to every position.
+    """
+    references = []
+    definitions = []
+    definition_end = -1
+    for match in FOOTNOTE_RE.finditer(text):
+        region = sublime.Region(offset + match.start(), offset + match.end())
+        label = match.group('definition')
+        if label is not None:
+            definitions.append((region, label))
+            definition_end = text.find('\n', match.end())
+            if definition_end == -1:
+                definition_end = len(text)
+        else:
+            references.append((region, match.group('reference'),
+                               match.start() < definition_end))
+    return references, definitions
+
+
+def dirty_lines(view, dirty):
+    """returns the whole lines touched by the dirty regions, merged"""
+    lines = []
+    for region in sorted(dirty, key=lambda r: r.begin()):
+        line = view.full_line(region)
+        if lines and line.begin() <= lines[-1].end():
+            lines[-1] = sublime.Region(lines[-1].begin(),
+                                       max(lines[-1].end(), line.end()))
+        else:
+            lines.append(line)
+    return lines
+
+
+def symbol(index):
+    """the label of the index-th (from 0) auto-symbol footnote"""
+    return SYMBOLS[index % len(SYMBOLS)] * (index // len(SYMBOLS) + 1)
+
+
+class FootnoteIndex(object):
+    """
+    the footnotes of a view by label, built from the lists returned
+    by scan_footnotes (with the regions as tracked by the view).
+
+    The labels are the ones docutils would render: auto-numbered
+    footnotes get the lowest numbers not taken by a numbered one, in
+    order, and the ``[#]_`` and ``[*]_`` references take the anonymous
+    notes in order. Citations are case insensitive. A reference that
+    can't be resolved keeps its label as written.
+    """
+    def __init__(self, references=(), definitions=()):
+        self.entries = (list(references), list(definitions))
+        self.references = {}
+        self.definitions = {}
+        self.last_number = 0
+
+        taken = set(label for _, label in self.entries[1] if label.isdigit())
+        number = 1
+        named = {}
+        anonymous = []
+        symbols = 0
+        self._definition_labels = {}
+        for region, label in self.entries[1]:
+            if label.startswith('#'):
+                while str(number) in taken:
+                    number += 1
+                effective = str(number)
+                number += 1
+                if label == '#':
+                    anonymous.append(effective)
+                else:
+                    named[label] = effective
+            elif label == '*':
+                effective = symbol(symbols)
+                symbols += 1
+            elif label.isdigit():
+                effective = label
+            else:
+                effective = label.lower()
+            self.definitions[effective] = region
+            self._definition_labels[region.begin()] = effective
+
+        anonymous.reverse()
+        symbols = 0
+        self.labels = []
+        for region, label, in_definition in self.entries[0]:
+            if label == '#':
+                effective = anonymous.pop() if anonymous else label
+            elif label.startswith('#'):
+                effective = named.get(label, label)
+            elif label == '*':
+                effective = symbol(symbols)
+                symbols += 1
+            elif label.isdigit():
+                effective = label
+            else:
+                effective = label.lower()
+            self.labels.append(effective)
+            if not in_definition:
+                self.references.setdefault(effective, []).append(region)
+                if effective.isdigit():
+                    self.last_number = max(self.last_number, int(effective))
+        self._begins = [region.begin() for region, _, _ in self.entries[0]]
+
+    def reference_at(self, point):
+        """returns the label of the reference that contains the point,
+           or None"""
+        index = bisect_right(self._begins, point) - 1
+        if index >= 0:
+            region = self.entries[0][index][0]
+            if region.begin() <= point <= region.end():
+                return self.labels[index]
+        return None
+
+    def definition_at(self, point):
+        """returns the label of the definition that starts at the point,
+           or None"""
+        return self._definition_labels.get(point)
+
+
+def find_orphans(index):
+    """
+    returns the regions of the references without a definition and
+    of the definitions that nothing references.
+    """
+    orphans = []
+    for (region, _, _), label in zip(index.entries[0], index.labels):
+        if label not in index.definitions:
+            orphans.append(region)
+    referenced = set(index.labels)
+    for region, _ in index.entries[1]:
+        if index.definition_at(region.begin()) not in referenced:
+            orphans.append(region)
+    orphans.sort(key=lambda r: r.begin())
+    return orphans
 
 
 def get_footnote_references(view):
-    ids = {}
-    for ref in view.get_regions(REFERENCE_KEY):
-        view.substr(view.line(ref))
-        if not re.match(DEFINITION_REGEX, view.substr(view.line(ref))):
-            id = get_id(view.substr(ref))
-            if id in ids:
-                ids[id].append(ref)
-            else:
-                ids[id] = [ref]
-    return ids
+    return FootnoteTracker.index(view).references
 
 
 def get_footnote_definition_markers(view):
-    ids = {}
-    for defn in view.get_regions(DEFINITION_KEY):
-        id = get_id(view.substr(defn))
-        ids[id] = defn
-    return ids
+    return FootnoteTracker.index(view).definitions
 
 
 def get_footnote_identifiers(view):
-    ids = get_footnote_references(view).keys()
-    list(ids).sort()
-    return ids
+    return sorted(get_footnote_references(view).keys())
 
 
 def get_last_footnote_marker(view):
-    ids = sorted([int(a) for a in get_footnote_identifiers(view) if a.isdigit()])
-    if len(ids):
-        return int(ids[-1])
-    else:
-        return 0
+    return FootnoteTracker.index(view).last_number
 
 
 def get_next_footnote_marker(view):
@@ -59,11 +212,8 @@ def is_footnote_definition(view):
 
 
 def is_footnote_reference(view):
-    refs = view.get_regions(REFERENCE_KEY)
-    for ref in refs:
-        if ref.contains(view.sel()[0]):
-            return True
-    return False
+    index = FootnoteTracker.index(view)
+    return index.reference_at(view.sel()[0].begin()) is not None
 
 
 def strip_trailing_whitespace(view, edit):
@@ -72,23 +222,147 @@ def strip_trailing_whitespace(view, edit):
         view.erase(edit, tws)
 
 
-class Footnotes(sublime_plugin.EventListener):
-    def update_footnote_data(self, view):
-        view.add_regions(REFERENCE_KEY,
-                         view.find_all(REFERENCE_REGEX),
-                         '', 'cross',
-                         )
-        view.add_regions(DEFINITION_KEY,
-                         view.find_all(DEFINITION_REGEX),
-                         '',
-                         'cross',
-                         )
+class FootnoteTracker(sublime_plugin.EventListener):
+    """
+    keeps the footnote references and definitions of reStructuredText
+    views as regions, and their FootnoteIndex, updated once the typing
+    pauses.
+    """
+    pending = {}
+    indexes = {}
+
+    @classmethod
+    def schedule(cls, view):
+        if not is_rst(view):
+            return
+        vid = view.id()
+        count = cls.pending[vid] = cls.pending.get(vid, 0) + 1
+
+        def debounced():
+            # a later change scheduled its own update
+            if cls.pending.get(vid) == count:
+                sublime.set_timeout(lambda: cls.update(view), 0)
+        sublime.set_timeout_async(debounced, UPDATE_DELAY)
+
+    @classmethod
+    def update(cls, view):
+        """scan the view if it has changes pending or was never scanned."""
+        vid = view.id()
+        if cls.pending.pop(vid, None) is None and vid in cls.indexes:
+            return
+        if not view.is_valid():
+            return
+        index = cls.indexes.get(vid)
+        dirty = view.get_regions(DIRTY_KEY)
+        if INCREMENTAL and index is not None:
+            if not dirty:
+                return
+            references, definitions = cls.rescan(view, index, dirty)
+        else:
+            references, definitions = scan_footnotes(
+                view.substr(sublime.Region(0, view.size())))
+        view.erase_regions(DIRTY_KEY)
+        view.add_regions(REFERENCE_KEY, [e[0] for e in references],
+                         '', 'cross', sublime.HIDDEN)
+        view.add_regions(DEFINITION_KEY, [e[0] for e in definitions],
+                         '', 'cross', sublime.HIDDEN)
+        cls.indexes[vid] = FootnoteIndex(references, definitions)
+        FootnoteDiagnostics.check(view, cls.indexes[vid])
+
+    @classmethod
+    def rescan(cls, view, index, dirty):
+        """
+        scans only the lines touched by the dirty regions. The footnotes
+        out of those lines are kept, with their regions as tracked by
+        the view: Sublime Text shifts them with the text.
+        """
+        lines = dirty_lines(view, dirty)
+        begins = [line.begin() for line in lines]
+
+        def keep(region):
+            if region.empty():
+                return False
+            i = bisect_left(begins, region.end()) - 1
+            return i < 0 or lines[i].end() <= region.begin()
+
+        tracked = []
+        for key, entries in zip((REFERENCE_KEY, DEFINITION_KEY), index.entries):
+            regions = view.get_regions(key)
+            if len(regions) != len(entries):
+                # lost track. Scan everything again
+                return scan_footnotes(view.substr(sublime.Region(0, view.size())))
+            tracked.append([(region,) + entry[1:]
+                            for region, entry in zip(regions, entries)
+                            if keep(region)])
+        references, definitions = tracked
+        for line in lines:
+            found = scan_footnotes(view.substr(line), line.begin())
+            references.extend(found[0])
+            definitions.extend(found[1])
+        references.sort(key=lambda e: e[0].begin())
+        definitions.sort(key=lambda e: e[0].begin())
+        return references, definitions
+
+    @classmethod
+    def index(cls, view):
+        """returns the up to date FootnoteIndex of the view"""
+        cls.update(view)
+        return cls.indexes.get(view.id()) or FootnoteIndex()
 
     def on_modified(self, view):
-        self.update_footnote_data(view)
+        self.schedule(view)
 
     def on_load(self, view):
-        self.update_footnote_data(view)
+        FootnoteTracker.indexes.pop(view.id(), None)
+        self.schedule(view)
+
+    def on_close(self, view):
+        FootnoteTracker.pending.pop(view.id(), None)
+        FootnoteTracker.indexes.pop(view.id(), None)
+
+
+class FootnoteDiagnostics(object):
+    """
+    marks the orphan footnotes of a view in the gutter, when
+    ``footnote_diagnostics`` is enabled. They are found in a background
+    thread each time the FootnoteIndex changes, and the result is dropped
+    if the view changed in the meantime.
+    """
+    @classmethod
+    def check(cls, view, index):
+        settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+        if not settings.get('footnote_diagnostics', True):
+            view.erase_regions(ORPHAN_KEY)
+            return
+        count = view.change_count()
+
+        def work():
+            orphans = find_orphans(index)
+            sublime.set_timeout(lambda: cls.show(view, count, orphans), 0)
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def show(cls, view, count, orphans):
+        if not view.is_valid() or view.change_count() != count:
+            return
+        view.add_regions(ORPHAN_KEY, orphans, 'invalid', 'dot', ORPHAN_FLAGS)
+
+
+if INCREMENTAL:
+    class FootnoteChangeListener(sublime_plugin.TextChangeListener):
+        """
+        marks the text changed in the buffer as dirty regions, for the
+        next FootnoteTracker update.
+        """
+        def on_text_changed(self, changes):
+            start, end, delta = merge_changes(changes)
+            for view in self.buffer.views():
+                if is_rst(view):
+                    dirty = view.get_regions(DIRTY_KEY)
+                    dirty.append(sublime.Region(start, end + delta))
+                    view.add_regions(DIRTY_KEY, dirty, '', '', sublime.HIDDEN)
 
 
 class MagicFootnotesCommand(sublime_plugin.TextCommand):
@@ -122,24 +396,83 @@ class InsertFootnoteCommand(sublime_plugin.TextCommand):
         return bool(self.view.sel())
 
 
-class MarkFootnotes(sublime_plugin.EventListener):
-    def update_footnote_data(self, view):
-        view.add_regions(REFERENCE_KEY, view.find_all(REFERENCE_REGEX), '', 'cross', sublime.HIDDEN)
-        view.add_regions(DEFINITION_KEY, view.find_all(DEFINITION_REGEX), '', 'cross', sublime.HIDDEN)
-
-    def on_modified(self, view):
-        self.update_footnote_data(view)
+class RenumberFootnotesCommand(sublime_plugin.TextCommand):
+    """
+    renumber the numbered footnotes in order of first appearance of
+    their references, with a single edit.
+    """
+    def run(self, edit):
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        references, definitions = scan_footnotes(text)
+        # auto-numbered, auto-symbol and citations are left as they are
+        references = [e for e in references if e[1].isdigit()]
+        definitions = [e for e in definitions if e[1].isdigit()]
+
+        # footnotes referenced from the text come first, then the ones
+        # only referenced from notes or not referenced at all.
+        numbers = {}
+        for region, label, in_definition in references:
+            if not in_definition and label not in numbers:
+                numbers[label] = str(len(numbers) + 1)
+        others = [(r, label) for r, label, in_definition in references if in_definition]
+        others.extend(definitions)
+        for region, label in sorted(others, key=lambda e: e[0].begin()):
+            if label not in numbers:
+                numbers[label] = str(len(numbers) + 1)
+
+        # (begin, end, new label) of every label to change
+        changes = []
+        for region, label, in_definition in references:
+            if numbers[label] != label:
+                begin = region.begin() + 1
+                changes.append((begin, begin + len(label), numbers[label]))
+        for region, label in definitions:
+            if numbers[label] != label:
+                end = region.end() - 1
+                changes.append((end - len(label), end, numbers[label]))
+        if not changes:
+            sublime.status_message('Footnotes already in order')
+            return
+        changes.sort()
+
+        first, last = changes[0][0], changes[-1][1]
+        chunk = []
+        position = first
+        ends = []
+        deltas = []
+        delta = 0
+        for begin, end, new_label in changes:
+            chunk.append(text[position:begin])
+            chunk.append(new_label)
+            position = end
+            delta += len(new_label) - (end - begin)
+            ends.append(end)
+            deltas.append(delta)
+        chunk.append(text[position:last])
+
+        def moved(point):
+            # shift of the changes fully before the point
+            i = bisect_right(ends, point) - 1
+            return point + (deltas[i] if i >= 0 else 0)
+
+        selection = [(moved(r.a), moved(r.b)) for r in self.view.sel()]
+        self.view.replace(edit, sublime.Region(first, last), ''.join(chunk))
+        self.view.sel().clear()
+        for a, b in selection:
+            self.view.sel().add(sublime.Region(a, b))
+        sublime.status_message('%d footnotes renumbered' % len(numbers))
 
-    def on_load(self, view):
-        self.update_footnote_data(view)
+    def is_enabled(self):
+        return bool(self.view.sel())
 
 
 class GoToFootnoteReferenceCommand(sublime_plugin.TextCommand):
     def run(self, edit):
-        refs = get_footnote_references(self.view)
-        match = is_footnote_definition(self.view)
-        if match:
-            target = match.groups()[0]
+        index = FootnoteTracker.index(self.view)
+        line = self.view.line(self.view.sel()[-1])
+        target = index.definition_at(line.begin())
+        if target in index.references:
+            refs = index.references
             self.view.sel().clear()
             note = refs[target][0]
             point = sublime.Region(note.end(), note.end())
@@ -152,32 +485,19 @@ class GoToFootnoteReferenceCommand(sublime_plugin.TextCommand):
 
 class GoToFootnoteDefinitionCommand(sublime_plugin.TextCommand):
     def run(self, edit):
-        defs = get_footnote_definition_markers(self.view)
-        regions = self.view.get_regions(REFERENCE_KEY)
+        index = FootnoteTracker.index(self.view)
 
         sel = self.view.sel()
         if len(sel) == 1:
-            target = None
-            selreg = sel[0]
-
-            for region in regions:
-                # cursor beetwen the brackects
-                #  ·[X]·_
-                if selreg.intersects(region):
-                    target = self.view.substr(region)[1:-2]
-            if not target:
-                # cursor is just after the underscore: [X]_·
-                try:
-                    a = self.view.find(REFERENCE_REGEX, sel[0].end() - 4)
-                    target = self.view.substr(a)[1:-2]
-                except:
-                    pass
-            if target:
+            # cursor beetwen the brackects ·[X]·_  or just after the underscore
+            target = index.reference_at(sel[0].begin())
+            if target in index.definitions:
+                definition = index.definitions[target]
                 self.view.sel().clear()
-                point = defs[target].end() + 1
+                point = definition.end() + 1
                 ref = sublime.Region(point, point)
                 self.view.sel().add(ref)
-                self.view.show(defs[target])
+                self.view.show(definition)
 
     def is_enabled(self):
         return bool(self.view.sel())
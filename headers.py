@@ -1,12 +1,13 @@
 import sublime
 import sublime_plugin
 import re
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
 # py3 import compatibility. Better way to do this?
 try:
-    from .helpers import BaseBlockCommand
+    from .helpers import BaseBlockCommand, merge_changes
 except ValueError:
-    from helpers import BaseBlockCommand    # NOQA
+    from helpers import BaseBlockCommand, merge_changes    # NOQA
 
 
 # reference:
@@ -29,8 +30,10 @@ class RstHeaderTree(object):
 
         self.headers = self._parse('\n' + text)
         self._text_lenght = len(text)
+        self._starts = [h.start for h in self.headers]
+        self._links = None
 
-    def _parse(self, text):
+    def _parse(self, text, offset=0):
         """
         Given a chunk of restructuredText, returns a list of tuples
         (level, start, end, adornment, title, raw) for each header found.
@@ -45,14 +48,16 @@ class RstHeaderTree(object):
         title: the parsed title
         raw : the raw parsed header text, including breaks.
 
+        offset is added to every position, when the chunk doesn't start
+        at the beginning of the document.
         """
 
-        candidates = PATTERN_RE.findall(text)
         headers = []
         levels = []
         idx = 0
 
-        for over, title, under in candidates:
+        for match in PATTERN_RE.finditer(text):
+            over, title, under = match.groups()
             # validate.
             if ((over == '' or over == under) and len(under) >= len(title)
                     and len(set(under)) == 1):
@@ -62,27 +67,133 @@ class RstHeaderTree(object):
                     levels.append(adornment)
                 level = levels.index(adornment)
                 raw = (over + '\n' if over else '') + title + '\n' + under
-                start = text.find(raw) - 1  # see comment on __init__
+                # without overline, the match starts at the previous break
+                start = offset + match.start(1 if over else 2) - 1  # see comment on __init__
                 end = start + len(raw)
                 h = Header(level, start, end, adornment, title, raw, idx)
                 idx += 1
                 headers.append(h)
         return headers
 
+    def update(self, start, end, delta, read, size, window=1024):
+        """
+        Update the headers after the text between ``start`` and ``end``
+        (offsets before the change) was replaced, changing the document
+        length by ``delta``.
+
+        read: a function that returns the new text between two offsets.
+        size: the new length of the document.
+
+        A header never spans an empty line, so only the lines between
+        the closer empty lines around the change are parsed again.
+        Headers after them are just shifted, and levels are recomputed
+        only if an adornment appeared or disappeared.
+        """
+        # bounds of the chunk to parse again, as new offsets.
+        # Both empty lines must be out of the changed text.
+        chunk_start = None
+        begin = start
+        while chunk_start is None:
+            begin = max(0, begin - window)
+            found = read(begin, start).rfind('\n\n')
+            if found != -1:
+                chunk_start = begin + found + 2
+            elif begin == 0:
+                chunk_start = 0
+            window *= 4
+
+        chunk_end = None
+        new_end = end + delta
+        stop = new_end
+        while chunk_end is None:
+            stop = min(size, stop + window)
+            found = read(new_end, stop).find('\n\n')
+            if found != -1:
+                chunk_end = new_end + found + 1
+            elif stop == size:
+                chunk_end = size
+            window *= 4
+
+        first = bisect_left(self._starts, chunk_start)
+        last = bisect_left(self._starts, chunk_end - delta)
+        removed = self.headers[first:last]
+        added = self._parse('\n' + read(chunk_start, chunk_end), chunk_start)
+        same_levels = ([h.adornment for h in removed] ==
+                       [h.adornment for h in added])
+
+        headers = self.headers[:first]
+        for i, h in enumerate(added):
+            level = removed[i].level if same_levels else h.level
+            headers.append(h._replace(level=level, idx=len(headers)))
+        if delta == 0 and len(removed) == len(added):
+            headers.extend(self.headers[last:])
+            self._starts[first:last] = [h.start for h in added]
+        else:
+            for h in self.headers[last:]:
+                headers.append(Header(h.level, h.start + delta, h.end + delta,
+                                      h.adornment, h.title, h.raw,
+                                      len(headers)))
+            self._starts = [h.start for h in headers]
+        if not same_levels:
+            levels = []
+            for i, h in enumerate(headers):
+                if h.adornment not in levels:
+                    levels.append(h.adornment)
+                headers[i] = h._replace(level=levels.index(h.adornment))
+
+        self.headers = headers
+        self._text_lenght += delta
+        self._links = None
+
+    def _sections(self):
+        """
+        returns the (ends, nexts, prevs) lists, indexed by header.idx:
+
+        ends: the offset where the section under each header ends.
+        nexts: the index of the next header with the same or higher level
+               (i.e. the one that closes the section), or None
+        prevs: the index of the previous header with the same or
+               higher level, or None
+
+        They are computed in one pass with a stack of open sections,
+        the first time they are needed after a change.
+        """
+        if self._links is None:
+            count = len(self.headers)
+            ends = [self._text_lenght] * count
+            nexts = [None] * count
+            prevs = [None] * count
+            opened = []
+            for h in self.headers:
+                while opened and self.headers[opened[-1]].level >= h.level:
+                    closed = opened.pop()
+                    ends[closed] = h.start - 1
+                    nexts[closed] = h.idx
+                    if self.headers[closed].level == h.level:
+                        prevs[h.idx] = closed
+                # the opened sections have increasing levels, so
+                # the closer one left is the parent.
+                if prevs[h.idx] is None and opened:
+                    prevs[h.idx] = opened[-1]
+                opened.append(h.idx)
+            self._links = ends, nexts, prevs
+        return self._links
+
+    def _contains(self, header):
+        return (0 <= header.idx < len(self.headers) and
+                self.headers[header.idx] == header)
+
     def belong_to(self, pos):
         """
         given a cursor position, return the deeper header
         that contains it
         """
-        match = []
-        for h in self.headers:
-            start, end = self.region(h)
-            if start <= pos <= end:
-                match.append(h)
-        try:
-            return sorted(match, key=lambda h: h.level, reverse=True)[0]
-        except IndexError:
+        # sections are nested: the last header before the position
+        # is the deeper one whose region contains it.
+        index = bisect_right(self._starts, pos) - 1
+        if index < 0:
             return None
+        return self.headers[index]
 
     def region(self, header):
         """
@@ -90,56 +201,41 @@ class RstHeaderTree(object):
         A region ends when a header of the same or higher level
         (i.e lower number) is found or at the EOF
         """
-
-        try:
-            index = self.headers.index(header)
-        except ValueError:
+        if not self._contains(header):
             return
+        ends = self._sections()[0]
+        return (header.start, ends[header.idx])
 
-        start = header.start
-        if index == len(self.headers) - 1:     # last header
-            return (start, self._text_lenght)
-
-        for next_h in self.headers[index + 1:]:
-            if next_h.level <= header.level:
-                return (start, next_h.start - 1)
-
-        return (start, self._text_lenght)
-
-    def _index(self, header, same_or_high=False):
+    def next(self, header, same_or_high=False):
         """
-        helper method that returns the absolute index
-        of the header in the tree or a filteredr tree
+        given a header returns the closer header
+        (down direction)
         If same_or_high is true, only move to headline with the same level
         or higher level.
-
-        returns (index, headers)
         """
+        if not self._contains(header):
+            raise ValueError('header not in the tree')
         if same_or_high:
-            headers = [h for h in self.headers
-                       if h.level <= header.level]
+            index = self._sections()[1][header.idx]
         else:
-            headers = self.headers[:]
-        return headers.index(header), headers
-
-    def next(self, header, same_or_high=False):
-        """
-        given a header returns the closer header
-        (down direction)
-        """
-        index, headers = self._index(header, same_or_high)
-        try:
-            return headers[index + 1]
-        except IndexError:
+            index = header.idx + 1
+        if index is None or index >= len(self.headers):
             return None
+        return self.headers[index]
 
     def prev(self, header, same_or_high=False, offset=-1):
-        """same than next, but in reversed direction
+        """same than next, but in reversed direction.
+        With offset 0, returns the header itself (unless it's the first one)
         """
-        index, headers = self._index(header, same_or_high)
-        if index == 0:
+        if not self._contains(header):
+            raise ValueError('header not in the tree')
+        if same_or_high:
+            index = self._sections()[2][header.idx]
+        else:
+            index = header.idx - 1
+        if index is None or index < 0:
             return None
-        return headers[index + offset]
+        return header if offset == 0 else self.headers[index]
 
     def levels(self):
         """ returns the heading adornment map"""
@@ -173,6 +269,64 @@ class RstHeaderTree(object):
         return result
 
 
+class HeaderTreeCache(sublime_plugin.EventListener):
+    """
+    keeps the RstHeaderTree of each view, to parse the buffer again
+    only when it has changed.
+    """
+    trees = {}
+
+    @classmethod
+    def get(cls, view):
+        vid = view.id()
+        change_count = view.change_count()
+        cached = cls.trees.get(vid)
+        if cached and cached[0] == change_count:
+            return cached[1]
+        tree = RstHeaderTree(view.substr(sublime.Region(0, view.size())))
+        cls.trees[vid] = (change_count, tree)
+        return tree
+
+    @classmethod
+    def update(cls, view, changes):
+        """
+        update the cached tree of the view from a list of changes made to
+        its buffer, each one relative to the text left by the previous one.
+        """
+        cached = cls.trees.pop(view.id(), None)
+        if cached is None or not changes:
+            return
+        tree = cached[1]
+        start, end, delta = merge_changes(changes)
+        size = view.size()
+        if tree._text_lenght + delta != size:
+            # out of sync. Parse it again on the next use
+            return
+
+        def read(a, b):
+            return view.substr(sublime.Region(a, b))
+
+        tree.update(start, end, delta, read, size)
+        cls.trees[view.id()] = (view.change_count(), tree)
+
+    def on_close(self, view):
+        vid = view.id()
+        HeaderTreeCache.trees.pop(vid, None)
+        HeaderChangeLevelCommand.views.pop(vid, None)
+        HeaderChangeLevelEvent.listen.pop(vid, None)
+
+
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class HeaderTreeUpdater(sublime_plugin.TextChangeListener):
+        """
+        keeps the cached header trees in sync with the buffer changes,
+        without parsing the whole text again (Sublime Text 4 only).
+        """
+        def on_text_changed(self, changes):
+            for view in self.buffer.views():
+                HeaderTreeCache.update(view, changes)
+
+
 class HeaderChangeLevelCommand(sublime_plugin.TextCommand):
     """
     increase or decrease the header level,
@@ -186,8 +340,7 @@ class HeaderChangeLevelCommand(sublime_plugin.TextCommand):
         HeaderChangeLevelEvent.listen.pop(vid, None)
 
         cursor_pos = self.view.sel()[0].begin()
-        region = sublime.Region(0, self.view.size())
-        tree = RstHeaderTree(self.view.substr(region))
+        tree = HeaderTreeCache.get(self.view)
 
         parent = tree.belong_to(cursor_pos)
 
@@ -241,8 +394,7 @@ class HeadlineMoveCommand(sublime_plugin.TextCommand):
 
         """
         cursor_pos = self.view.sel()[0].begin()
-        region = sublime.Region(0, self.view.size())
-        tree = RstHeaderTree(self.view.substr(region))
+        tree = HeaderTreeCache.get(self.view)
         parent = tree.belong_to(cursor_pos)
 
         if forward:
@@ -261,6 +413,37 @@ class HeadlineMoveCommand(sublime_plugin.TextCommand):
         self.view.show(region)
 
 
+class HeadlineGotoCommand(HeadlineMoveCommand):
+    """Show every section in a quick panel, indented by level,
+    and jump to the selected one.
+
+    If max_depth is given, only the sections up to that
+    depth are listed (1 means top level sections only).
+
+    """
+
+    def run(self, edit, max_depth=None):
+        tree = HeaderTreeCache.get(self.view)
+        headers = [h for h in tree.headers
+                   if max_depth is None or h.level < max_depth]
+        if not headers:
+            sublime.status_message('No sections found')
+            return
+
+        items = ['    ' * h.level + h.title.strip() for h in headers]
+        cursor_pos = self.view.sel()[0].begin()
+        selected = max(0, bisect_right([h.start for h in headers], cursor_pos) - 1)
+
+        def on_done(index):
+            if index == -1:
+                return
+            h = headers[index]
+            self.jump_to(h.end - len(h.raw.split('\n')[-1]) - 1)
+
+        self.view.window().show_quick_panel(items, on_done,
+                                            sublime.MONOSPACE_FONT, selected)
+
+
 class SmartFoldingCommand(sublime_plugin.TextCommand):
     """Smart folding is used to fold / unfold headline at the point.
 
@@ -271,8 +454,7 @@ class SmartFoldingCommand(sublime_plugin.TextCommand):
     def run(self, edit):
 
         cursor_pos = self.view.sel()[0].begin()
-        region = sublime.Region(0, self.view.size())
-        tree = RstHeaderTree(self.view.substr(region))
+        tree = HeaderTreeCache.get(self.view)
         parent = tree.belong_to(cursor_pos)
         is_in_header = parent.start <= cursor_pos <= parent.end
         if is_in_header:
@@ -8,7 +8,72 @@ class LineIndexError(Exception):
     pass
 
 
+def find_block(text, pos, complete_start=True, complete_end=True):
+    """given a chunk of text and a position inside it, returns the
+       (start, stop) limits of the block of non blank lines around
+       the position. ``stop`` is the end of the block's last line.
+
+       If a limit can't be decided because the block reaches an edge of
+       the chunk that is not an edge of the document (i.e. the line
+       there could be truncated), returns None"""
+    # upward
+    start = text.rfind('\n', 0, pos) + 1
+    while True:
+        if start == 0:
+            if not complete_start:
+                return None
+            break
+        prev = text.rfind('\n', 0, start - 1) + 1
+        if prev == 0 and not complete_start:
+            return None
+        if not text[prev:start - 1].strip():
+            break
+        start = prev
+
+    # downward
+    stop = text.find('\n', pos)
+    while True:
+        if stop == -1:
+            if not complete_end:
+                return None
+            stop = len(text)
+            break
+        next_stop = text.find('\n', stop + 1)
+        if next_stop == -1:
+            if not complete_end:
+                return None
+            line = text[stop + 1:]
+        else:
+            line = text[stop + 1:next_stop]
+        if not line.strip():
+            break
+        stop = next_stop
+    return start, stop
+
+
+def merge_changes(changes):
+    """given a list of TextChange (Sublime Text 4), each one relative to
+       the text left by the previous one, returns a single equivalent
+       change as (start, end, delta): the replaced range, in offsets
+       before the changes, and the length difference"""
+    start = end = None
+    delta = 0
+    for change in changes:
+        a, b = change.a.pt, change.b.pt
+        if start is None:
+            start, end = a, b
+        else:
+            end += max(0, b - (end + delta))
+            start = min(start, a)
+        delta += len(change.str) - (b - a)
+    return start, end, delta
+
+
 class BaseBlockCommand(sublime_plugin.TextCommand):
+    # size of the first chunk of text fetched around the cursor
+    # by get_block_bounds. It's multiplied until the block fits.
+    block_window = 4096
+
     def _get_row_text(self, row):
 
         if row < 0 or row > self.view.rowcol(self.view.size())[0]:
@@ -19,37 +84,42 @@ class BaseBlockCommand(sublime_plugin.TextCommand):
         text = self.view.substr(region)
         return text
 
+    def iter_lines(self, point):
+        """yields (begin, text) for each line from point, which must be
+           the beginning of a line, reading the view in chunks"""
+        size = self.view.size()
+        window = self.block_window
+        while point < size:
+            end = min(size, point + window)
+            lines = self.view.substr(Region(point, end)).split('\n')
+            if end < size:
+                # the last line could be truncated
+                lines.pop()
+            for line in lines:
+                yield point, line
+                point += len(line) + 1
+            window *= 4
+
     def get_cursor_position(self):
         return self.view.rowcol(self.view.sel()[0].begin())
 
     def get_block_bounds(self):
         """given the cursor position as started point,
            returns the limits and indentation"""
-        row, col = self.get_cursor_position()
-        upper = lower = row
-
-        try:
-            while self._get_row_text(upper - 1).strip():
-                upper -= 1
-        except LineIndexError:
-            pass
-        else:
-            upper += 1
+        point = self.view.sel()[0].begin()
+        size = self.view.size()
+        window = self.block_window
+        while True:
+            begin = max(0, point - window)
+            end = min(size, point + window)
+            text = self.view.substr(Region(begin, end))
+            bounds = find_block(text, point - begin, begin == 0, end == size)
+            if bounds is not None:
+                break
+            window *= 4
 
-        try:
-            while self._get_row_text(lower + 1).strip():
-                lower += 1
-        except LineIndexError:
-            pass
-        else:
-            lower -= 1
-
-        block_region = Region(self.view.text_point(upper - 1, 0),
-                              self.view.text_point(lower + 2, 0))
-        lines = [self.view.substr(region) for region in self.view.lines(block_region)]
-        try:
-            row_text = self._get_row_text(upper - 1)
-        except LineIndexError:
-            row_text = ''
-        indent = re.match('^(\s*).*$', row_text).group(1)
+        start, stop = bounds
+        block_region = Region(begin + start, min(begin + stop + 1, size))
+        lines = text[start:stop].split('\n')
+        indent = re.match(r'^(\s*).*$', lines[0]).group(1)
         return block_region, lines, indent
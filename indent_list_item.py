@@ -1,16 +1,23 @@
 import re
 
 import sublime
-import sublime_plugin
+try:
+    from .helpers import BaseBlockCommand
+    from .lists import ENUMERATOR_PATTERN
+except ValueError:
+    from helpers import BaseBlockCommand    # NOQA
+    from lists import ENUMERATOR_PATTERN    # NOQA
 
 
-class IndentListItemCommand(sublime_plugin.TextCommand):
-    bullet_pattern = r'([-+*]|([(]?(\d+|#|[a-y]|[A-Y]|[MDCLXVImdclxvi]+))([).]))'
+class IndentListItemCommand(BaseBlockCommand):
+    bullet_pattern = r'([-+*]|([(]?(%s))([).]))' % ENUMERATOR_PATTERN
     bullet_pattern_re = re.compile(bullet_pattern)
     line_pattern_re = re.compile(r'^\s*' + bullet_pattern)
     spaces_re = re.compile(r'^\s*')
 
-    def run(self, edit, reverse=False):
+    def run(self, edit, reverse=False, subtree=False):
+        if subtree:
+            return self.run_subtree(edit, reverse)
         for region in self.view.sel():
             if region.a != region.b:
                 continue
@@ -81,5 +88,57 @@ class IndentListItemCommand(sublime_plugin.TextCommand):
             self.view.replace(edit, line, '')
             self.view.run_command('insert_snippet', {'contents': new_line})
 
+    def get_subtree(self, line):
+        """returns the lines of the list item at line and its nested
+           content, as (begin, text) tuples"""
+        text = self.view.substr(line)
+        indent = len(self.spaces_re.match(text).group(0))
+        lines = [(line.begin(), text)]
+        blank = []
+        for begin, text in self.iter_lines(line.end() + 1):
+            if not text.strip():
+                blank.append((begin, text))
+                continue
+            if len(self.spaces_re.match(text).group(0)) <= indent:
+                break
+            lines.extend(blank)
+            lines.append((begin, text))
+            blank = []
+        return lines
+
+    def run_subtree(self, edit, reverse=False):
+        """indent (or unindent) the list items under the selections with
+           their nested items and content, in a single edit. The bullets
+           are kept."""
+        tab_str = self.view.settings().get('tab_size', 4) * ' '
+        roots = []
+        for region in self.view.sel():
+            for line in self.view.lines(region):
+                if self.line_pattern_re.match(self.view.substr(line)):
+                    roots.append(line)
+        roots.sort(key=lambda line: line.begin())
+
+        changes = []
+        covered = -1
+        for line in roots:
+            if line.begin() <= covered:
+                # nested in a subtree already moved
+                continue
+            lines = self.get_subtree(line)
+            covered = lines[-1][0]
+            if reverse and not lines[0][1].startswith(tab_str):
+                continue
+            for begin, text in lines:
+                if reverse:
+                    spaces = min(len(text) - len(text.lstrip(' ')), len(tab_str))
+                    if spaces:
+                        changes.append((begin, begin + spaces, ''))
+                elif text.strip():
+                    changes.append((begin, begin, tab_str))
+
+        # from the bottom, so the positions of the others hold
+        for begin, end, text in reversed(changes):
+            self.view.replace(edit, sublime.Region(begin, end), text)
+
     def is_enabled(self):
         return bool(self.view.score_selector(self.view.sel()[0].a, 'text.restructuredtext'))
@@ -20,12 +20,12 @@ except ValueError:
 
 
 
-ORDER_LIST_PATTERN = re.compile(r"(\s*[(]?)(\d+|[a-y]|[A-Y])([.)]\s+)(.*)")
-UNORDER_LIST_PATTERN = re.compile(r"(\s*(?:[-+|*]+|[(]?#[).]))(\s+)\S+")
-EMPTY_LIST_PATTERN = re.compile(r"(\s*)([-+*]|[(]?(?:\d+|[a-y]|[A-Y]|#|[MDCLXVImdclxvi]+)[.)])(\s+)$")
+ORDER_LIST_PATTERN = re.compile(r"(\s*[(]?)(\d+|#|[a-z]+|[A-Z]+)([.)]\s+)(.*)")
+UNORDER_LIST_PATTERN = re.compile(r"(\s*[-+|*]+)(\s+)\S+")
+# the enumerators of the ordered list items the key bindings know
+ENUMERATOR_PATTERN = r"\d+|#|[a-z]{1,2}|[A-Z]{1,2}|[MDCLXVImdclxvi]+"
+EMPTY_LIST_PATTERN = re.compile(r"(\s*)([-+*]|[(]?(?:%s)[.)])(\s+)$" % ENUMERATOR_PATTERN)
 NONLIST_PATTERN = re.compile(r"(\s*[>|%]+)(\s+)\S?")
-ROMAN_PATTERN = re.compile(r"(\s*[(]?)(M{0,4}CM|CD|D?C{0,3}XC|XL|L?X{0,3}IX|IV|V?I{0,3})([.)]\s+)(.*)",
-                           re.IGNORECASE)
 #Define digit mapping
 ROMAN_MAP = (('M', 1000),
              ('CM', 900),
@@ -40,6 +40,10 @@ ROMAN_MAP = (('M', 1000),
              ('V', 5),
              ('IV', 4),
              ('I', 1))
+ROMAN_LIMIT = 4999
+
+# letters enumerate up to ``zz``: longer words are too often plain text
+ALPHA_LIMIT = 26 + 26 * 26
 
 #Define exceptions
 class RomanError(Exception): pass
@@ -47,84 +51,118 @@ class NotIntegerError(RomanError): pass
 class InvalidRomanNumeralError(RomanError): pass
 
 
+# (labels, numbers) lookup tables by kind, see get_table
+_tables = {}
+
+
+def get_table(name):
+    """returns the lookup tables of the 'roman' or 'alpha' numerals,
+       built the first time they are needed: a list of the labels by
+       number (from 1) and a dict of the numbers by label"""
+    if name not in _tables:
+        if name == 'roman':
+            labels = ['']
+            for n in range(1, ROMAN_LIMIT + 1):
+                numeral = ''
+                for symbol, integer in ROMAN_MAP:
+                    if n >= integer:
+                        # the numeral of the rest is already known
+                        numeral = symbol + labels[n - integer]
+                        break
+                labels.append(numeral)
+        else:
+            letters = [chr(c) for c in range(ord('A'), ord('Z') + 1)]
+            labels = [''] + letters + [a + b for a in letters for b in letters]
+        numbers = dict((label, n) for n, label in enumerate(labels) if n)
+        _tables[name] = labels, numbers
+    return _tables[name]
+
+
 def to_roman(n):
     """convert integer to Roman numeral"""
-    if not (0 < n < 5000):
+    if not (0 < n <= ROMAN_LIMIT):
         raise Exception("number out of range (must be 1..4999)")
-    result = ""
-    for numeral, integer in ROMAN_MAP:
-        while n >= integer:
-            result += numeral
-            n -= integer
-    return result
+    return get_table('roman')[0][n]
 
 def from_roman(s):
     """convert Roman numeral to integer"""
-    result = 0
-    index = 0
-    for numeral, integer in ROMAN_MAP:
-        while s[index:index + len(numeral)] == numeral:
-            result += integer
-            index += len(numeral)
-    return result
+    try:
+        return get_table('roman')[1][s]
+    except KeyError:
+        raise InvalidRomanNumeralError('Invalid Roman numeral: %s' % s)
+
+
+def to_alpha(n):
+    """convert integer to letters: A to Z, then AA, AB... up to ZZ"""
+    if not (0 < n <= ALPHA_LIMIT):
+        raise Exception("number out of range (must be 1..%d)" % ALPHA_LIMIT)
+    return get_table('alpha')[0][n]
+
+
+def parse_enumerator(label, previous=None):
+    """returns (kind, number) for the enumerator of a list item, or None
+       if the label isn't one. kind is 'arabic', 'auto' (``#``), or
+       'lower' or 'upper' followed by 'alpha' or 'roman'.
+
+       Labels like ``i`` or ``v`` are both a letter and a roman numeral:
+       the label of the previous item of the list, if given, settles it.
+       Otherwise a single letter is a letter, except ``i``."""
+    if label == '#':
+        return 'auto', 0
+    if label.isdigit():
+        return 'arabic', int(label)
+    if label.islower():
+        case = 'lower'
+    elif label.isupper():
+        case = 'upper'
+    else:
+        return None
+    roman = get_table('roman')[1].get(label.upper())
+    alpha = get_table('alpha')[1].get(label.upper())
+    if roman and alpha:
+        before = previous and parse_enumerator(previous)
+        if before == (case + 'alpha', alpha - 1):
+            roman = None
+        elif before != (case + 'roman', roman - 1) and len(label) == 1 and label not in 'iI':
+            roman = None
+    if roman:
+        return case + 'roman', roman
+    if alpha:
+        return case + 'alpha', alpha
+    return None
+
+
+def format_enumerator(kind, number):
+    """returns the label of the number-th item of a list of the given
+       kind, or None past the last one (``zz`` for letters)"""
+    if kind == 'auto':
+        return '#'
+    if kind == 'arabic':
+        return str(number)
+    limit = ROMAN_LIMIT if kind.endswith('roman') else ALPHA_LIMIT
+    if number > limit:
+        return None
+    if kind.endswith('roman'):
+        label = to_roman(number)
+    else:
+        label = to_alpha(number)
+    return label.lower() if kind.startswith('lower') else label
+
+
+def continues_list(label, enumerator, previous=None):
+    """tells whether a label is a list item. Two letters only are when
+       they follow the previous item: a line starting with ``cf.`` or
+       ``vs.`` is just text"""
+    kind, number = enumerator
+    if not kind.endswith('alpha') or len(label) == 1:
+        return True
+    return previous is not None and parse_enumerator(previous) == (kind, number - 1)
 
 
 class SmartListCommand(BaseBlockCommand):
 
 
     def run(self, edit):
-
-        def update_ordered_list(lines):
-            new_lines = []
-            next_num = None
-            kind = lambda a: a
-            for line in lines:
-                match = ORDER_LIST_PATTERN.match(line)
-                if not match:
-                    new_lines.append(line)
-                    continue
-                new_line = match.group(1) + \
-                              (kind(next_num) or match.group(2)) + \
-                              match.group(3) + match.group(4)
-                new_lines.append(new_line)
-
-                if not next_num:
-                    try:
-                        next_num = int(match.group(2))
-                        kind = str
-                    except ValueError:
-                        next_num = ord(match.group(2))
-                        kind = chr
-                next_num += 1
-            return new_lines
-
-        def update_roman_list(lines):
-            new_lines = []
-            next_num = None
-            kind = lambda a: a
-            for line in lines:
-                match = ROMAN_PATTERN.match(line)
-                if not match:
-                    new_lines.append(line)
-                    continue
-                new_line = match.group(1) + \
-                              (kind(next_num) or match.group(2)) + \
-                              match.group(3) + match.group(4)
-                new_lines.append(new_line)
-
-                if not next_num:
-                    actual = match.group(2)
-                    next_num = from_roman(actual.upper())
-
-                    if actual == actual.lower():
-                        kind = lambda a: to_roman(a).lower()
-                    else:
-                        kind = to_roman
-                next_num += 1
-            return new_lines
-
-
-
         for region in self.view.sel():
             line_region = self.view.line(region)
             # the content before point at the current line.
@@ -149,56 +187,22 @@ class SmartListCommand(BaseBlockCommand):
                 self.view.insert(edit, line_region.a, insert_text)
                 break
 
-            match = ROMAN_PATTERN.match(before_point_content)
-            if match:
-                actual = match.group(2)
-                next_num = to_roman(from_roman(actual.upper()) + 1)
-                if actual == actual.lower():
-                    next_num = next_num.lower()
-
-                insert_text = match.group(1) + \
-                              next_num + \
-                              match.group(3)
-                self.view.insert(edit, region.a, "\n" + insert_text)
-
-                # backup the cursor position
-                pos = self.view.sel()[0].a
-
-                # update the whole list
-                region, lines, indent = self.get_block_bounds()
-                new_list = update_roman_list(lines)
-                self.view.replace(edit, region, '\n'.join(new_list) + '\n')
-                # restore the cursor position
-                self.view.sel().clear()
-                self.view.sel().add(sublime.Region(pos, pos))
-                self.view.show(pos)
-
-                break
-
-
             match = ORDER_LIST_PATTERN.match(before_point_content)
+            enumerator = None
             if match:
-                try:
-                    next_num = str(int(match.group(2)) + 1)
-                except ValueError:
-                    next_num = chr(ord(match.group(2)) + 1)
-
-                insert_text = match.group(1) + \
-                              next_num + \
-                              match.group(3)
+                previous = self.previous_label(line_region.a, match.group(1))
+                enumerator = parse_enumerator(match.group(2), previous)
+                if enumerator and not continues_list(match.group(2), enumerator, previous):
+                    enumerator = None
+            # nothing to continue with after the last label
+            label = enumerator and format_enumerator(enumerator[0], enumerator[1] + 1)
+            if label:
+                kind, num = enumerator
+                insert_text = match.group(1) + label + match.group(3)
                 self.view.insert(edit, region.a, "\n" + insert_text)
 
-                # backup the cursor position
-                pos = self.view.sel()[0].a
-
-                # update the whole list
-                region, lines, indent = self.get_block_bounds()
-                new_list = update_ordered_list(lines)
-                self.view.replace(edit, region, '\n'.join(new_list) + '\n')
-                # restore the cursor position
-                self.view.sel().clear()
-                self.view.sel().add(sublime.Region(pos, pos))
-                self.view.show(pos)
+                self.renumber_following(edit, region.a + 1 + len(insert_text),
+                                        match.group(1), kind, num + 2)
                 break
 
             match = UNORDER_LIST_PATTERN.match(before_point_content)
@@ -217,6 +221,51 @@ class SmartListCommand(BaseBlockCommand):
                              re.sub(r'\S+\s*', '', before_point_content))
         self.adjust_view()
 
+    def previous_label(self, point, prefix):
+        """returns the label of the list item before the line at point
+           with the same indentation and prefix, if any"""
+        indent = len(prefix) - len(prefix.lstrip())
+        while point > 0:
+            line_region = self.view.line(point - 1)
+            line = self.view.substr(line_region)
+            point = line_region.a
+            if not line.strip():
+                break
+            line_indent = len(line) - len(line.lstrip())
+            if line_indent > indent:
+                continue
+            match = ORDER_LIST_PATTERN.match(line)
+            if line_indent == indent and match and match.group(1) == prefix:
+                return match.group(2)
+            break
+        return None
+
+    def renumber_following(self, edit, point, prefix, kind, next_num):
+        """renumber the items after the line at point that are at the
+           same level of the list, starting with next_num. Nested items
+           are skipped and only the enumerators that change are replaced:
+           the first item already in order ends the renumbering."""
+        indent = len(prefix) - len(prefix.lstrip())
+        point = self.view.line(point).end() + 1
+        changes = []
+        for begin, line in self.iter_lines(point):
+            if not line.strip():
+                break
+            line_indent = len(line) - len(line.lstrip())
+            if line_indent > indent:
+                continue
+            match = ORDER_LIST_PATTERN.match(line)
+            if line_indent < indent or not match or match.group(1) != prefix:
+                break
+            label = format_enumerator(kind, next_num)
+            if label is None or match.group(2) == label:
+                break
+            changes.append((begin + match.start(2), begin + match.end(2), label))
+            next_num += 1
+        # from the bottom, so the positions of the others hold
+        for start, end, label in reversed(changes):
+            self.view.replace(edit, sublime.Region(start, end), label)
+
     def adjust_view(self):
         for region in self.view.sel():
             self.view.show(region)
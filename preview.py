@@ -0,0 +1,317 @@
+"""Live html preview of reStructuredText views, served on localhost."""
+
+import sublime
+import sublime_plugin
+import webbrowser
+import tempfile
+import threading
+import time
+import os
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer    # NOQA
+    from SocketServer import ThreadingMixIn    # NOQA
+    from urlparse import urlparse, parse_qs    # NOQA
+try:
+    from .render import DocutilsJob, in_process, current_toolchain, remove
+    from .toolchain import run_with_timeout
+except ValueError:
+    from render import DocutilsJob, in_process, current_toolchain, remove    # NOQA
+    from toolchain import run_with_timeout    # NOQA
+
+# milliseconds without changes before rendering the preview again
+PREVIEW_DELAY = 300
+
+# seconds a page waits for a new version before asking again
+POLL_TIMEOUT = 25
+
+# reloads the page when the server has a newer version of it
+RELOAD_SCRIPT = '''<script>
+(function poll(version) {
+    var request = new XMLHttpRequest();
+    request.open('GET', '/poll/%(id)d?version=' + version);
+    request.onload = function () {
+        if (request.status != 200) {
+            return;
+        }
+        if (request.responseText != String(version)) {
+            location.reload();
+        } else {
+            poll(version);
+        }
+    };
+    request.onerror = function () {
+        setTimeout(function () { poll(version); }, 2000);
+    };
+    request.send();
+})(%(version)d);
+</script>
+'''
+
+WAITING_PAGE = b'<html><body><p>Rendering...</p></body></html>'
+
+
+def render_html(text, file_name, timeout, toolchain):
+    """returns the html of the reStructuredText, rendered with docutils
+       in process if possible (see in_process), or with rst2html.py"""
+    if in_process(text, toolchain):
+        html, errors = DocutilsJob.publish(text, file_name)
+    else:
+        html, errors = render_with_tool(text, file_name, timeout, toolchain)
+    if html is None:
+        html = (u'<html><body><pre>%s</pre></body></html>' %
+                errors.replace('&', '&amp;').replace('<', '&lt;')).encode('utf-8')
+    return html, errors
+
+
+def render_with_tool(text, file_name, timeout, toolchain):
+    """returns the html of rst2html.py for the text, or None, and its
+       messages"""
+    tool = toolchain.get('rst2html')
+    if tool is None:
+        return None, 'rst2html.py not found'
+    cwd = os.path.dirname(file_name) if file_name else None
+    data = text.encode('utf-8')
+    outfile = None if tool.stream_output else new_file('.html')
+    command = tool.get_stream_command(outfile)
+    infile = None
+    if command is None:
+        infile = new_file('.rst')
+        with open(infile, 'wb') as source:
+            source.write(data)
+        data = None
+        command = tool.get_command(infile, outfile)
+    try:
+        returncode, html, errors = run_with_timeout(command, timeout, cwd,
+                                                    tool.env, data)
+        if outfile is not None and returncode == 0:
+            with open(outfile, 'rb') as output:
+                html = output.read()
+    except Exception as e:
+        return None, str(e)
+    finally:
+        for path in (infile, outfile):
+            if path is not None:
+                remove(path)
+    if returncode != 0:
+        html = None
+    return html, errors.decode('utf-8', 'replace')
+
+
+def new_file(suffix):
+    """returns the path of a new temporary file"""
+    handle, path = tempfile.mkstemp(suffix=suffix)
+    os.close(handle)
+    return path
+
+
+class PreviewDocument(object):
+    """
+    the html of a previewed view. The text submitted is rendered in a
+    background thread: only one render runs at a time, and the texts
+    submitted meanwhile are coalesced into the next one.
+    """
+    def __init__(self, file_name, timeout, toolchain):
+        self.file_name = file_name
+        self.timeout = timeout
+        self.toolchain = toolchain
+        self.html = WAITING_PAGE
+        self.version = 0
+        self.pending = None
+        self.rendering = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def submit(self, text):
+        with self.condition:
+            self.pending = text
+            if self.rendering:
+                return
+            self.rendering = True
+        thread = threading.Thread(target=self.render)
+        thread.daemon = True
+        thread.start()
+
+    def render(self):
+        while True:
+            with self.condition:
+                text = self.pending
+                self.pending = None
+                if text is None or self.closed:
+                    self.rendering = False
+                    return
+            html, errors = render_html(text, self.file_name, self.timeout,
+                                       self.toolchain)
+            with self.condition:
+                self.html = html
+                self.version += 1
+                self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """returns the current version once it's not the given one, or
+           after timeout seconds"""
+        end = time.time() + timeout
+        with self.condition:
+            while self.version == version and not self.closed:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.version
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    """serves ``/view/<view id>`` and ``/poll/<view id>?version=<n>``"""
+
+    def do_GET(self):
+        # only pages of this server: a name rebound to 127.0.0.1 by
+        # another site doesn't read the documents
+        port = self.server.server_address[1]
+        if self.headers.get('Host') not in ('127.0.0.1:%d' % port, 'localhost:%d' % port):
+            self.send_error(403)
+            return
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        document = None
+        if len(parts) == 2 and parts[1].isdigit():
+            document = LivePreview.documents.get(int(parts[1]))
+        if document is None:
+            self.send_error(404)
+            return
+        if parts[0] == 'view':
+            with document.condition:
+                html, version = document.html, document.version
+            script = (RELOAD_SCRIPT % {'id': int(parts[1]), 'version': version})
+            script = script.encode('utf-8')
+            end = html.rfind(b'</body>')
+            if end == -1:
+                end = len(html)
+            body = html[:end] + script + html[end:]
+            content_type = 'text/html; charset=utf-8'
+        elif parts[0] == 'poll':
+            version = parse_qs(url.query).get('version', ['0'])[0]
+            version = int(version) if version.isdigit() else 0
+            body = str(document.wait(version, POLL_TIMEOUT)).encode('utf-8')
+            content_type = 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PreviewServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LivePreview(object):
+    """the http server on localhost and the documents it serves"""
+    server = None
+    documents = {}
+
+    @classmethod
+    def start(cls):
+        if cls.server is None:
+            settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+            address = ('127.0.0.1', settings.get('preview_port', 0))
+            cls.server = PreviewServer(address, PreviewHandler)
+            thread = threading.Thread(target=cls.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def stop(cls):
+        for vid in list(cls.documents):
+            cls.documents.pop(vid).close()
+        if cls.server is not None:
+            server, cls.server = cls.server, None
+
+            # shutdown waits for the serving loop to notice
+            def shutdown():
+                server.shutdown()
+                server.server_close()
+            thread = threading.Thread(target=shutdown)
+            thread.daemon = True
+            thread.start()
+
+    @classmethod
+    def open(cls, view):
+        """returns the url of the preview of the view, started if needed"""
+        cls.start()
+        if view.id() not in cls.documents:
+            settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+            document = PreviewDocument(view.file_name(),
+                                       settings.get('render_timeout', 60),
+                                       current_toolchain())
+            cls.documents[view.id()] = document
+            document.submit(view.substr(sublime.Region(0, view.size())))
+        return 'http://%s:%d/view/%d' % (cls.server.server_address[:2] + (view.id(),))
+
+    @classmethod
+    def close(cls, view):
+        document = cls.documents.pop(view.id(), None)
+        if document is not None:
+            document.close()
+        if not cls.documents:
+            cls.stop()
+
+
+class LivePreviewListener(sublime_plugin.EventListener):
+    """renders the previews again once the typing pauses"""
+    pending = {}
+
+    def on_modified(self, view):
+        vid = view.id()
+        if vid not in LivePreview.documents:
+            return
+        count = self.pending[vid] = self.pending.get(vid, 0) + 1
+
+        def debounced():
+            # a later change scheduled its own render
+            if self.pending.get(vid) == count:
+                sublime.set_timeout(lambda: self.submit(view), 0)
+        sublime.set_timeout_async(debounced, PREVIEW_DELAY)
+
+    def submit(self, view):
+        document = LivePreview.documents.get(view.id())
+        self.pending.pop(view.id(), None)
+        if document is not None and view.is_valid():
+            document.submit(view.substr(sublime.Region(0, view.size())))
+
+    def on_close(self, view):
+        self.pending.pop(view.id(), None)
+        if view.id() in LivePreview.documents:
+            LivePreview.close(view)
+
+
+class LivePreviewRstCommand(sublime_plugin.TextCommand):
+    """opens the live preview of the view in the browser, or stops it"""
+
+    def run(self, edit, stop=False):
+        if stop:
+            LivePreview.close(self.view)
+            sublime.status_message('Live preview stopped')
+            return
+        webbrowser.open_new_tab(LivePreview.open(self.view))
+
+    def is_enabled(self):
+        return self.view.score_selector(0, 'text.restructuredtext') > 0
+
+
+def plugin_unloaded():
+    LivePreview.stop()
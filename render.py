@@ -7,33 +7,336 @@ import re
 import os.path
 import sys
 import subprocess
+import threading
+import copy
+import hashlib
+import textwrap
+import time
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from .headers import HeaderTreeCache
+    from .render_project import render_tree, SourceState, DEFAULT_OUTPUT
+    from .toolchain import get_toolchain, run_with_timeout, kill
+except ValueError:
+    from headers import HeaderTreeCache    # NOQA
+    from render_project import render_tree, SourceState, DEFAULT_OUTPUT    # NOQA
+    from toolchain import get_toolchain, run_with_timeout, kill    # NOQA
+try:
+    from docutils.core import Publisher, publish_string
+except ImportError:
+    # docutils is not available in the plugin host: rst2html.py is used
+    publish_string = None
 
+# the output panel for the messages of the tools
+PANEL_NAME = 'rst_render'
 
-class RenderRstCommand(sublime_plugin.TextCommand):
 
-    TARGETS = ['html (pandoc)', 'html (rst2html)', 'pdf (pandoc)',
-               'pdf (rst2pdf)', 'odt (pandoc)', 'odt (rst2odt)',
-               'docx (pandoc)']
+def show_panel(window, text, name=PANEL_NAME):
+    """shows text in an output panel of the window"""
+    if hasattr(window, 'create_output_panel'):
+        panel = window.create_output_panel(name)
+    else:
+        panel = window.get_output_panel(name)
+    panel.run_command('append', {'characters': text})
+    window.run_command('show_panel', {'panel': 'output.' + name})
+
+
+# the start of a substitution definition or a named hyperlink target
+# (anonymous targets only make sense with all the anonymous references)
+DEFINITION_RE = re.compile(r"^([ \t]*)\.\.[ \t]+(?:\|[^|\n]+\|[ \t]|_(?!_:))",
+                           re.MULTILINE)
+
+
+def get_definitions(text, start, end):
+    """returns the substitution definitions and hyperlink targets of
+       the text, out of the start:end slice, as a list of blocks"""
+    blocks = []
+    for match in DEFINITION_RE.finditer(text):
+        if start <= match.start() < end:
+            continue
+        indent = len(match.group(1))
+        # the block goes on up to a blank or less indented line
+        block_end = text.find('\n', match.start())
+        while block_end != -1:
+            line_end = text.find('\n', block_end + 1)
+            line = text[block_end + 1:line_end if line_end != -1 else len(text)]
+            if not line.strip() or len(line) - len(line.lstrip()) <= indent:
+                break
+            block_end = line_end
+        if block_end == -1:
+            block_end = len(text)
+        blocks.append(textwrap.dedent(text[match.start():block_end]).rstrip())
+    return blocks
+
+
+def get_section_source(text, start, end):
+    """returns the section of the text between start and end, followed
+       by the definitions of the rest of the document it could use"""
+    blocks = [text[start:end].rstrip()] + get_definitions(text, start, end)
+    return '\n\n'.join(blocks) + '\n'
+
 
-    def __init__(self, view):
-        sublime_plugin.TextCommand.__init__(self, view)
-        path_pieces = os.environ['PATH'].split(":")
-        new_path = []
-        
-        def append_path(bit):
-           if bit != "" and bit not in new_path:
-                new_path.append(bit) 
+def current_toolchain():
+    """returns the Toolchain for the current settings, its versions asked
+       in the background the first time"""
+    settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+    toolchain = get_toolchain(settings.get('command_path', []),
+                              settings.get('render_tools', {}))
+    toolchain.probe_versions()
+    return toolchain
 
-        for bit in path_pieces:
-            append_path(bit)
 
-        settings = sublime.load_settings('sublime-rst-completion.sublime-settings');
+def in_process(contents, toolchain):
+    """tells whether the html of the contents is rendered with docutils
+       in the plugin host. That can't be stopped, so documents bigger than
+       ``docutils_max_size`` characters go to rst2html.py if it's found"""
+    if publish_string is None:
+        return False
+    settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+    if len(contents) <= settings.get('docutils_max_size', 200000):
+        return True
+    return toolchain.get('rst2html') is None
+
+
+def remove(path):
+    """removes a file, if it's still there"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class RenderCache(object):
+    """
+    the rendered documents, named after a hash of what they were made
+    from, in a directory of the Sublime Text cache. The least recently
+    used are removed when the directory grows over ``render_cache_size``
+    megabytes. The documents being rendered are written in another
+    directory, out of reach of the eviction.
+    """
+    @staticmethod
+    def directory(name='render'):
+        if hasattr(sublime, 'cache_path') and sublime.cache_path():
+            base = sublime.cache_path()
+        else:
+            base = tempfile.gettempdir()
+        path = os.path.join(base, 'sublime-rst-completion', name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    @staticmethod
+    def key(contents, tool, target, file_name=None, dependencies=None):
+        """the hash of the encoded contents, the tool and the target.
+           The file name counts too, as relative includes depend on it,
+           and the {path: hash} of the files included"""
+        digest = hashlib.sha1(contents)
+        for part in (tool, target, file_name or ''):
+            digest.update(b'\0' + part.encode('utf-8'))
+        for path, sha in sorted((dependencies or {}).items()):
+            digest.update(('\0%s\0%s' % (path, sha)).encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def path(cls, key, target):
+        return os.path.join(cls.directory(), '%s.%s' % (key, target))
 
-        for bit in settings.get('command_path', []):
-            append_path(bit)
+    @classmethod
+    def get(cls, key, target):
+        """returns the path of the document if it's cached, or None"""
+        path = cls.path(key, target)
+        if not os.path.exists(path):
+            return None
+        # most recently used
+        os.utime(path, None)
+        return path
 
-        os.environ['PATH'] = ":".join(new_path)
+    @classmethod
+    def new_file(cls, target):
+        """returns the path of a new file in the staging directory, to be
+           stored with the key once complete"""
+        handle, path = tempfile.mkstemp(suffix='.' + target, dir=cls.directory('staging'))
+        os.close(handle)
+        return path
+
+    @classmethod
+    def store(cls, path, key, target):
+        """moves a complete file into the cache, and returns its path, or
+           None if it couldn't be moved"""
+        final = cls.path(key, target)
+        remove(final)
+        try:
+            os.rename(path, final)
+        except OSError:
+            remove(path)
+            return None
+        cls.evict()
+        return final
 
+    @classmethod
+    def evict(cls):
+        settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+        limit = settings.get('render_cache_size', 64) * 1024 * 1024
+        directory = cls.directory()
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        # the newest is kept even if it's bigger than the limit
+        for mtime, size, path in files[:-1]:
+            if total <= limit:
+                break
+            remove(path)
+            total -= size
+
+
+class RenderJob(object):
+    """
+    a command run in a background thread, stopped if it takes longer
+    than timeout seconds. The callback is called in the main thread
+    with the job, the return code (None if the command could not be
+    started) and the text written to stderr.
+    """
+    def __init__(self, cmd, timeout, cwd=None, infile=None, env=None,
+                 data=None, outfile=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.cwd = cwd
+        self.env = env
+        # a temporary input, removed once the command ends
+        self.infile = infile
+        # bytes written to the stdin of the command, and the file its
+        # stdout goes to
+        self.data = data
+        self.outfile = outfile
+        self.process = None
+        self.cancelled = False
+        self.timed_out = False
+        self.lock = threading.Lock()
+
+    def start(self, callback):
+        thread = threading.Thread(target=self.run, args=(callback,))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, callback):
+        try:
+            self.run_command(callback)
+        finally:
+            if self.infile is not None:
+                remove(self.infile)
+
+    def run_command(self, callback):
+        if self.cancelled:
+            return
+        output = subprocess.PIPE
+        try:
+            if self.outfile is not None:
+                output = open(self.outfile, 'wb')
+            returncode, stdout, stderr = run_with_timeout(
+                self.cmd, self.timeout, self.cwd, self.env, self.data, output,
+                self.started, self.expire)
+        except Exception as e:
+            message = str(e)
+            sublime.set_timeout(lambda: callback(self, None, message), 0)
+            return
+        finally:
+            if output is not subprocess.PIPE:
+                output.close()
+        errors = stderr.decode('utf-8', 'replace')
+        sublime.set_timeout(lambda: callback(self, returncode, errors), 0)
+
+    def started(self, process):
+        with self.lock:
+            self.process = process
+            if self.cancelled:
+                self.kill()
+
+    def expire(self):
+        self.timed_out = True
+        self.kill()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            self.kill()
+
+    def kill(self):
+        if self.process is not None:
+            kill(self.process)
+
+
+class DocutilsJob(RenderJob):
+    """
+    a RenderJob that renders html with the docutils of the plugin host,
+    from the buffer contents straight to the output file. Its thread
+    can't be stopped: a cancelled job just doesn't report.
+    """
+    # docutils settings, parsed once
+    settings = None
+
+    def __init__(self, source, source_path, outfile):
+        RenderJob.__init__(self, None, None)
+        self.source = source
+        self.source_path = source_path
+        self.outfile = outfile
+
+    @classmethod
+    def get_settings(cls):
+        if cls.settings is None:
+            publisher = Publisher()
+            publisher.set_components('standalone', 'restructuredtext', 'html')
+            cls.settings = publisher.get_settings(output_encoding='utf-8')
+        # the publisher changes some of them while rendering
+        settings = copy.copy(cls.settings)
+        settings.warning_stream = StringIO()
+        return settings
+
+    @classmethod
+    def publish(cls, source, source_path=None):
+        """returns the html of the source, or None if it failed, and the
+           messages of docutils"""
+        settings = cls.get_settings()
+        try:
+            html = publish_string(source, source_path=source_path,
+                                  writer_name='html', settings=settings)
+        except Exception as e:
+            settings.warning_stream.write(u'%s\n' % e)
+            html = None
+        return html, settings.warning_stream.getvalue()
+
+    def run(self, callback):
+        html, errors = self.publish(self.source, self.source_path)
+        returncode = 1
+        if html is not None:
+            with open(self.outfile, 'wb') as output:
+                output.write(html)
+            returncode = 0
+        sublime.set_timeout(lambda: callback(self, returncode, errors), 0)
+
+    def kill(self):
+        pass
+
+
+class RenderRstCommand(sublime_plugin.TextCommand):
+
+    TARGETS = ['html (pandoc)', 'html (rst2html)', 'pdf (pandoc)',
+               'pdf (rst2pdf)', 'odt (pandoc)', 'odt (rst2odt)',
+               'docx (pandoc)', 'html section (rst2html)']
+
+    # the RenderJob running for each view, by view id
+    jobs = {}
+
+    # render again even if a result is cached
+    force = False
 
     def is_enabled(self):
         return True
@@ -41,64 +344,143 @@ class RenderRstCommand(sublime_plugin.TextCommand):
     def is_visible(self):
         return True
 
-    def run(self, edit):
+    def is_available(self, toolchain, label):
+        tool = re.match(r".* \((.*)\)", label).group(1)
+        if tool == 'rst2html' and publish_string is not None:
+            return True
+        return toolchain.get(tool) is not None
+
+    def describe(self, toolchain, label):
+        tool = re.match(r".* \((.*)\)", label).group(1)
+        if tool == 'rst2html' and publish_string is not None:
+            return 'docutils, in process'
+        found = toolchain.get(tool)
+        # the version is known once probed in the background
+        return found.version or found.executable
+
+    def run(self, edit, force=False):
+        self.force = force
+        toolchain = current_toolchain()
         if not hasattr(self, 'targets'):
             self.targets = RenderRstCommand.TARGETS[:]
-        self.view.window().show_quick_panel(self.targets, self.convert,
+        for label in toolchain.targets():
+            if label not in self.targets:
+                self.targets.append(label)
+        self.shown = [label for label in self.targets
+                      if self.is_available(toolchain, label)]
+        if not self.shown:
+            sublime.error_message(
+                "No conversion tool found.\n"
+                "Install Pandoc, rst2pdf or docutils, and add the directories "
+                "where they are to \"command_path\" in the settings.")
+            return
+        items = [[label, self.describe(toolchain, label)] for label in self.shown]
+        self.view.window().show_quick_panel(items, self.convert,
                                             sublime.MONOSPACE_FONT)
 
     def convert(self, target_index):
         if target_index == -1:
             # canceled
             return
-        target, tool = re.match(r"(.*) \((.*)\)",
-                                self.targets[target_index]).groups()
+        label = self.shown[target_index]
+        target, section, tool = re.match(r"(\w+)( section)? \((.*)\)",
+                                         label).groups()
 
         # update targets: last used turns the first option
-        self.targets.insert(0, self.targets.pop(target_index))
+        self.targets.remove(label)
+        self.targets.insert(0, label)
         encoding = self.view.encoding()
         if encoding == 'Undefined':
             encoding = 'UTF-8'
         elif encoding == 'Western (Windows 1252)':
             encoding = 'windows-1252'
         contents = self.view.substr(sublime.Region(0, self.view.size()))
-        contents = contents.encode(encoding)
+        if section:
+            tree = HeaderTreeCache.get(self.view)
+            header = tree.belong_to(self.view.sel()[0].begin())
+            if header is None:
+                sublime.status_message('The cursor is not in a section')
+                return
+            contents = get_section_source(contents, *tree.region(header))
 
         file_name = self.view.file_name()
-        if file_name:
-            os.chdir(os.path.dirname(file_name))
-
-        # write buffer to temporary file
-        # This is useful because it means we don't need to save the buffer
-        with tempfile.NamedTemporaryFile(delete=False,
-                                         suffix=".rst") as tmp_rst:
-            tmp_rst.write(contents)
-
-        # output file...
-        suffix = "." + target
-        with tempfile.NamedTemporaryFile(delete=False,
-                                         suffix=suffix) as output:
-            output.close()
-            output_name = output.name
-
-        self.run_tool(tmp_rst.name, output_name, tool)
-        self.open_result(output_name, target)
-
-    def run_tool(self, infile, outfile, tool):
-        if tool in ("pandoc", "rst2pdf"):
-            cmd = [tool, infile, "-o", outfile]
-        else:
-            cmd = ["%s.py" % tool, infile, outfile]
+        cwd = os.path.dirname(file_name) if file_name else None
 
-        try:
-            if sys.platform == "win32":
-                subprocess.call(cmd, shell=True)
+        # the included files are part of the key, as read now
+        dependencies = SourceState().text_dependencies(contents, cwd or os.curdir)
+        key = RenderCache.key(contents.encode(encoding), tool, target, file_name,
+                              dependencies)
+        cached = None if self.force else RenderCache.get(key, target)
+        if cached is not None:
+            sublime.status_message('Rendered %s (unchanged)' % target)
+            self.open_result(cached, target)
+            return
+
+        # output file, moved into the cache once complete
+        output_name = RenderCache.new_file(target)
+
+        toolchain = current_toolchain()
+        if tool == 'rst2html' and in_process(contents, toolchain):
+            job = DocutilsJob(contents, file_name, output_name)
+        else:
+            found = toolchain.get(tool)
+            if found is None:
+                remove(output_name)
+                sublime.error_message("Fail to generate output.\n%s not found" % tool)
+                return
+            settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+            timeout = settings.get('render_timeout', 60)
+            command = found.get_stream_command(output_name)
+            if command is not None:
+                # the buffer goes through a pipe: no need to save it
+                job = RenderJob(command, timeout, cwd, env=found.env,
+                                data=contents.encode('utf-8'),
+                                outfile=output_name if found.stream_output else None)
             else:
-                subprocess.call(cmd, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
+                # write buffer to temporary file
+                # This is useful because it means we don't need to save the buffer
+                with tempfile.NamedTemporaryFile(delete=False,
+                                                 suffix=".rst") as tmp_rst:
+                    tmp_rst.write(contents.encode(encoding))
+                job = RenderJob(found.get_command(tmp_rst.name, output_name),
+                                timeout, cwd, tmp_rst.name, found.env)
 
-        except Exception as e:
-            sublime.error_message("Fail to generate output.\n{0}".format(e))
+        sublime.status_message('Rendering %s with %s...' % (target, tool))
+        self.start_job(job, lambda job, returncode, errors:
+                       self.finish(job, returncode, errors, output_name, target, key))
+
+    def start_job(self, job, callback):
+        """starts the job in the background, cancelling the render
+           still running for the view"""
+        previous = RenderRstCommand.jobs.get(self.view.id())
+        if previous is not None:
+            previous.cancel()
+        RenderRstCommand.jobs[self.view.id()] = job
+        job.start(callback)
+
+    def finish(self, job, returncode, errors, outfile, target, key):
+        if RenderRstCommand.jobs.get(self.view.id()) is job:
+            del RenderRstCommand.jobs[self.view.id()]
+        if job.cancelled or job.timed_out or returncode != 0:
+            remove(outfile)
+        if job.cancelled:
+            return
+        window = self.view.window() or sublime.active_window()
+        if errors.strip() and window is not None:
+            show_panel(window, errors)
+        if returncode is None:
+            sublime.error_message("Fail to generate output.\n{0}".format(errors))
+        elif job.timed_out:
+            sublime.status_message('Render stopped after %d seconds' % job.timeout)
+        elif returncode != 0:
+            sublime.status_message('Render failed (exit status %d)' % returncode)
+        else:
+            stored = RenderCache.store(outfile, key, target)
+            if stored is None:
+                sublime.status_message('Rendered %s, but the result was lost' % target)
+                return
+            sublime.status_message('Rendered %s' % target)
+            self.open_result(stored, target)
 
     def open_result(self, outfile, target):
         if target == "html":
@@ -110,3 +492,75 @@ class RenderRstCommand(sublime_plugin.TextCommand):
             print(outfile)
         elif "posix" in sys.platform or "linux" in sys.platform:
             os.system("xdg-open %s" % outfile)
+
+
+class RenderRstProjectCommand(sublime_plugin.WindowCommand):
+    """
+    renders to html the .rst files of the window folders that changed
+    since the last run, in the background. The time taken by each file
+    is shown in an output panel.
+    """
+    running = False
+
+    def run(self):
+        folders = self.window.folders()
+        if not folders:
+            sublime.status_message('No folders to render')
+            return
+        if RenderRstProjectCommand.running:
+            sublime.status_message('The project is already being rendered')
+            return
+        RenderRstProjectCommand.running = True
+        settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+        output = settings.get('project_render_output', DEFAULT_OUTPUT)
+        jobs = settings.get('project_render_jobs', 0)
+        timeout = settings.get('render_timeout', 60)
+        toolchain = current_toolchain()
+
+        def progress(done, total, source, seconds, error):
+            message = 'Rendering project: %d/%d' % (done, total)
+            sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
+        def work():
+            start = time.time()
+            try:
+                results, skipped = render_tree(folders, output, jobs, timeout, progress,
+                                               toolchain)
+            except Exception as e:
+                message = str(e)
+                sublime.set_timeout(lambda: sublime.error_message(
+                    "Fail to render the project.\n{0}".format(message)), 0)
+                return
+            finally:
+                RenderRstProjectCommand.running = False
+            elapsed = time.time() - start
+            sublime.set_timeout(lambda: self.report(results, skipped, elapsed), 0)
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    def report(self, results, skipped, elapsed):
+        lines = []
+        failed = 0
+        for source, seconds, error in sorted(results, key=lambda r: -r[1]):
+            lines.append('%8.2fs  %s%s' % (seconds, source, '  FAILED' if error else ''))
+            if error:
+                failed += 1
+                lines.extend('            ' + line for line in error.splitlines())
+        summary = '%d rendered, %d unchanged, %d failed in %.1fs' % (
+            len(results) - failed, skipped, failed, elapsed)
+        lines.append(summary)
+        sublime.status_message(summary)
+        show_panel(self.window, '\n'.join(lines) + '\n')
+
+
+def plugin_loaded():
+    # the versions are ready by the first time the targets are shown
+    settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+    settings.add_on_change('render_toolchain', current_toolchain)
+    sublime.set_timeout_async(current_toolchain, 0)
+
+
+def plugin_unloaded():
+    settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+    settings.clear_on_change('render_toolchain')
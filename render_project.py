@@ -0,0 +1,235 @@
+"""
+Renders every reStructuredText file under some folders to html, with
+rst2html.py processes in parallel. A file is rendered again only if it
+or one of the files it includes changed since the last run.
+
+It doesn't need Sublime Text::
+
+    python render_project.py [--output _build/html] [--jobs N] folder...
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+try:
+    from .toolchain import get_toolchain, run_with_timeout
+except (ValueError, ImportError, SystemError):
+    from toolchain import get_toolchain, run_with_timeout    # NOQA
+
+# the files a document pulls in: include and literalinclude directives, and
+# the :file: option of csv-table and raw
+INCLUDE_RE = re.compile(r"^[ \t]*(?:\.\.[ \t]+(?:literal)?include::|:file:)[ \t]*(\S.*?)[ \t]*$",
+                        re.MULTILINE)
+
+# the state of the last run, in the output directory
+MANIFEST_NAME = '.rst-render-manifest.json'
+
+DEFAULT_OUTPUT = os.path.join('_build', 'html')
+
+
+def find_sources(folder, output):
+    """yields the .rst files under the folder, out of hidden directories
+       and of the output directory"""
+    output = os.path.abspath(output)
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and
+                         os.path.abspath(os.path.join(root, d)) != output)
+        for name in sorted(files):
+            if name.endswith('.rst'):
+                yield os.path.join(root, name)
+
+
+def find_includes(text, directory):
+    """returns the paths of the files the text includes"""
+    found = []
+    for match in INCLUDE_RE.finditer(text):
+        name = match.group(1)
+        if name.startswith('<'):
+            # docutils' standard definition files
+            continue
+        found.append(os.path.normpath(os.path.join(directory, name)))
+    return found
+
+
+class SourceState(object):
+    """the hashes and includes of the files, read once per run"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.includes = {}
+
+    def hash(self, path):
+        if path not in self.hashes:
+            try:
+                with open(path, 'rb') as source:
+                    self.hashes[path] = hashlib.sha1(source.read()).hexdigest()
+            except (IOError, OSError):
+                self.hashes[path] = None
+        return self.hashes[path]
+
+    def direct_includes(self, path):
+        if path not in self.includes:
+            try:
+                with open(path, 'rb') as source:
+                    text = source.read().decode('utf-8', 'replace')
+            except (IOError, OSError):
+                text = ''
+            self.includes[path] = find_includes(text, os.path.dirname(path))
+        return self.includes[path]
+
+    def dependencies(self, path):
+        """returns {path: hash} of the file and all it includes"""
+        deps = {}
+        pending = [path]
+        while pending:
+            current = pending.pop()
+            if current in deps:
+                continue
+            deps[current] = self.hash(current)
+            pending.extend(self.direct_includes(current))
+        return deps
+
+    def text_dependencies(self, text, directory):
+        """returns {path: hash} of all the files a text not saved yet
+           includes, relative to the directory"""
+        deps = {}
+        for path in find_includes(text, directory):
+            deps.update(self.dependencies(path))
+        return deps
+
+
+def load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST_NAME)) as manifest:
+            return json.load(manifest)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(output, manifest):
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    with open(os.path.join(output, MANIFEST_NAME), 'w') as stream:
+        json.dump(manifest, stream, indent=1, sort_keys=True)
+
+
+def render_file(source, target, timeout, tool):
+    """runs the tool, returns (seconds, error message or None)"""
+    start = time.time()
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # made by another worker in the meantime
+            pass
+    try:
+        returncode, stdout, stderr = run_with_timeout(
+            tool.get_command(source, target), timeout, os.path.dirname(source), tool.env)
+    except Exception as e:
+        return time.time() - start, str(e)
+    error = None
+    if returncode != 0:
+        error = stderr.decode('utf-8', 'replace').strip() or \
+            'exit status %d' % returncode
+    return time.time() - start, error
+
+
+def render_tree(folders, output=DEFAULT_OUTPUT, jobs=0, timeout=60, progress=None,
+                toolchain=None):
+    """
+    renders the changed .rst files under the folders to html, in the
+    output directory of each folder, running up to jobs tools at once
+    (0 for one per CPU). progress, if given, is called from the workers
+    with (done, total, source, seconds, error) after each file.
+
+    Returns a list of (source, seconds, error) of the files rendered and
+    the number of files left untouched.
+    """
+    tool = (toolchain or get_toolchain()).get('rst2html')
+    if tool is None:
+        raise RuntimeError('rst2html.py not found')
+    work = []
+    manifests = {}
+    skipped = 0
+    state = SourceState()
+    for folder in folders:
+        folder = os.path.abspath(folder)
+        out = os.path.join(folder, output)
+        manifest = manifests[out] = load_manifest(out)
+        for source in find_sources(folder, out):
+            relative = os.path.relpath(source, folder)
+            target = os.path.join(out, os.path.splitext(relative)[0] + '.html')
+            deps = state.dependencies(source)
+            if manifest.get(relative) == deps and os.path.exists(target):
+                skipped += 1
+                continue
+            work.append((source, target, out, relative, deps))
+
+    lock = threading.Lock()
+    results = []
+
+    def render(item):
+        source, target, out, relative, deps = item
+        seconds, error = render_file(source, target, timeout, tool)
+        with lock:
+            results.append((source, seconds, error))
+            if error is None:
+                manifests[out][relative] = deps
+            else:
+                manifests[out].pop(relative, None)
+            done = len(results)
+        if progress is not None:
+            progress(done, len(work), source, seconds, error)
+
+    if work:
+        pool = ThreadPool(jobs or cpu_count())
+        try:
+            pool.map(render, work, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for out, manifest in manifests.items():
+            save_manifest(out, manifest)
+    return results, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('folders', nargs='+')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help='output directory, relative to each folder')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='tools running at once (default: one per CPU)')
+    parser.add_argument('--timeout', type=int, default=60)
+    parser.add_argument('--path', action='append', default=[],
+                        help='another directory to look for rst2html.py')
+    args = parser.parse_args(argv)
+
+    def progress(done, total, source, seconds, error):
+        sys.stdout.write('[%d/%d] %.2fs %s%s\n' % (
+            done, total, seconds, source, ' FAILED' if error else ''))
+
+    try:
+        results, skipped = render_tree(args.folders, args.output, args.jobs,
+                                       args.timeout, progress, get_toolchain(args.path))
+    except RuntimeError as e:
+        sys.stderr.write('%s\n' % e)
+        return 2
+    failed = [(source, error) for source, seconds, error in results if error]
+    for source, error in failed:
+        sys.stderr.write('%s:\n%s\n' % (source, error))
+    sys.stdout.write('%d rendered, %d unchanged, %d failed\n' % (
+        len(results) - len(failed), skipped, len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -47,14 +47,21 @@ Usage
    it will be fixed.
 
    And ``ctrl+r+t`` reflows the table fixing the current column width.
+
+   With ``"table_auto_format": true`` in the settings, the row under the cursor
+   is realigned while you type. The whole table is only redrawn when a column
+   needs to grow.
 """
 
 import re
 import textwrap
+
+import sublime
+import sublime_plugin
 try:
-    from .helpers import BaseBlockCommand
+    from .helpers import BaseBlockCommand, LineIndexError
 except ValueError:
-    from helpers import BaseBlockCommand    # NOQA
+    from helpers import BaseBlockCommand, LineIndexError    # NOQA
 
 import os
 import sys
@@ -73,12 +80,144 @@ class TableCommand(BaseBlockCommand):
         result += '\n'
         return result
 
-    def run(self, edit):
+    def run(self, edit, incremental=False):
+        if incremental and self.run_incremental(edit):
+            return
         region, lines, indent = self.get_block_bounds()
         table = parse_table(lines)
         widths = self.get_withs(lines)
         result = self.get_result(indent, table, widths)
-        self.view.replace(edit, region, result)
+        if self.view.substr(region) == result:
+            return
+        caret = None
+        if incremental and len(self.view.sel()) == 1:
+            row, col = self.get_cursor_position()
+            caret = (row - self.view.rowcol(region.begin())[0], col,
+                     cursor_cell(self._get_row_text(row), col))
+        self.replace(edit, region, result)
+        if caret is not None:
+            # back in the same cell of the same line, as it was typing
+            line_index, col, (cell, before, blank_after) = caret
+            new_lines = result.split('\n')
+            line_index = min(line_index, len(new_lines) - 1)
+            new_line = new_lines[line_index]
+            new_col = min(col, len(new_line))
+            if cell:
+                new_col = cell_column(new_line, cell, before, blank_after)
+                if new_col is None:
+                    new_col = cell_column(new_line, cell, before.rstrip(), blank_after)
+            point = region.begin() + sum(len(line) + 1 for line in new_lines[:line_index])
+            self.view.sel().clear()
+            self.view.sel().add(sublime.Region(point + new_col, point + new_col))
+
+    def replace(self, edit, region, result):
+        vid = self.view.id()
+        TableAutoFormatEvent.ignore.add(vid)
+        try:
+            self.view.replace(edit, region, result)
+        finally:
+            def callback():
+                TableAutoFormatEvent.ignore.discard(vid)
+            sublime.set_timeout(callback, 0)
+
+    def _find_row_separator(self, row, step):
+        """walk from the given row in the given direction (1 or -1)
+           until a separator line is found.
+           Returns its row number and text, or None if the row is not
+           inside a grid table"""
+        while True:
+            row += step
+            try:
+                text = self._get_row_text(row)
+            except LineIndexError:
+                return None
+            if line_is_separator(text):
+                return row, text
+            if not text.lstrip().startswith('|'):
+                return None
+
+    def run_incremental(self, edit):
+        """realign only the row under the cursor, keeping the current
+           column widths.
+
+           Returns False if a full redraw is needed instead: the cursor is
+           not in a grid table row or a column must grow"""
+        if len(self.view.sel()) != 1:
+            return False
+        row, col = self.get_cursor_position()
+        cursor_line = self._get_row_text(row)
+        if line_is_separator(cursor_line) or not cursor_line.lstrip().startswith('|'):
+            return False
+
+        upper = self._find_row_separator(row, -1)
+        lower = self._find_row_separator(row, 1)
+        if upper is None or lower is None:
+            return False
+        (upper, border), (lower, bottom) = upper, lower
+        widths = get_column_widths_from_border_spec([border])
+        if widths != get_column_widths_from_border_spec([bottom]):
+            # merged cells
+            return False
+
+        indent = re.match(r'^(\s*)', border).group(1)
+        raw_lines = [self._get_row_text(r) for r in range(upper + 1, lower)]
+        fields = join_rows([split_table_row(line) for line in raw_lines])
+        if len(fields) > len(widths):
+            return False
+        fields += [''] * (len(widths) - len(fields))
+
+        measured = measure_row(fields)
+        for i, field_lines in enumerate(measured):
+            if get_field_width(field_lines) > widths[i]:
+                return False
+
+        new_lines = [indent + '|'.join([''] + pad_fields(row_line, widths) + [''])
+                     for row_line in split_row_into_lines(measured)]
+        if new_lines == raw_lines:
+            return True
+
+        # keep the cursor in the same cell, at the same offset of its text
+        line_index = min(row - upper - 1, len(new_lines) - 1)
+        new_line = new_lines[line_index]
+        cell, before, blank_after = cursor_cell(cursor_line, col)
+        if cell:
+            new_col = cell_column(new_line, cell, before, blank_after)
+            if new_col is None:
+                # the spaces just typed after the text don't fit in the
+                # cell: left as they are until the text goes on
+                return True
+        else:
+            new_col = min(col, len(new_line))
+
+        region = sublime.Region(self.view.text_point(upper + 1, 0),
+                                self.view.line(self.view.text_point(lower - 1, 0)).end())
+        self.replace(edit, region, '\n'.join(new_lines))
+        point = self.view.text_point(upper + 1 + line_index, new_col)
+        self.view.sel().clear()
+        self.view.sel().add(sublime.Region(point, point))
+        return True
+
+
+class TableAutoFormatEvent(sublime_plugin.EventListener):
+    """realign the grid table row under the cursor while typing,
+       if ``table_auto_format`` is enabled"""
+    ignore = set()
+    commands = ('insert', 'left_delete', 'right_delete', 'paste')
+
+    def on_modified(self, view):
+        if view.id() in TableAutoFormatEvent.ignore or len(view.sel()) != 1:
+            return
+        settings = sublime.load_settings('sublime-rst-completion.sublime-settings')
+        if not settings.get('table_auto_format', False):
+            return
+        point = view.sel()[0].begin()
+        if not view.score_selector(point, 'text.restructuredtext'):
+            return
+        if view.command_history(0, True)[0] not in self.commands:
+            return
+        line = view.substr(view.line(point))
+        if line.lstrip().startswith('|') and not line_is_separator(line):
+            view.run_command('table', {'incremental': True})
 
 
 class FlowtableCommand(TableCommand):
@@ -174,6 +313,42 @@ def join_rows(rows, sep='\n'):
     return [sep.join(lines) for lines in output]
 
 
+def cursor_cell(line, col):
+    """given a row line and a column, returns the index of the cell it's
+    in (1 for the first, 0 if out of the cells), the text of the cell
+    before the column, without the leading spaces, and whether the rest
+    of the cell is blank.
+
+    """
+    bars = [m.start() for m in re.finditer(re.escape('|'), line)]
+    cell = line[:col].count('|')
+    if not 0 < cell < len(bars):
+        return 0, '', False
+    before = line[bars[cell - 1] + 1:max(col, bars[cell - 1] + 1)].lstrip()
+    return cell, before, not line[col:bars[cell]].strip()
+
+
+def cell_column(line, cell, before, blank_after):
+    """returns the column of a realigned row line at the same place of the
+    cell as given by ``cursor_cell``. The spaces typed at the end of the
+    cell text are kept, or None is returned if they don't fit in the cell.
+
+    """
+    bars = [m.start() for m in re.finditer(re.escape('|'), line)]
+    if not 0 < cell < len(bars):
+        return len(line)
+    start, end = bars[cell - 1] + 2, bars[cell] - 1
+    text = line[start:end].rstrip()
+    if blank_after:
+        stripped = before.rstrip()
+        offset = min(len(stripped), len(text)) + len(before) - len(stripped)
+        if start + offset > end:
+            return None
+    else:
+        offset = min(len(before), len(text))
+    return start + offset
+
+
 def line_is_separator(line):
     return re.match('^[\t +=-]+$', line)
 
@@ -270,12 +445,12 @@ def table_line(widths, header=False):
     return sep.join(parts)
 
 
-def get_field_width(field_text):
-    return max([wcwidth.wcswidth(s) for s in field_text.split('\n')])
+def get_field_width(field_lines):
+    """Given the measured lines of a field, returns its width."""
+    return max([width for line, width in field_lines])
 
 
 def split_row_into_lines(row):
-    row = [field.split('\n') for field in row]
     height = max([len(field_lines) for field_lines in row])
     turn_table = []
     for i in range(height):
@@ -284,21 +459,44 @@ def split_row_into_lines(row):
             if i < len(field_lines):
                 fields.append(field_lines[i])
             else:
-                fields.append('')
+                fields.append(('', 0))
         turn_table.append(fields)
     return turn_table
 
 
-def get_column_widths(table):
+def measure_row(row):
+    """Split each field of the row into lines, measuring every line once.
+
+    Returns a list of fields, each one a list of ``(text, width)`` tuples.
+
+    """
+    measured = []
+    for field in row:
+        lines = [line.strip() for line in field.split('\n')]
+        measured.append([(line, wcwidth.wcswidth(line)) for line in lines])
+    return measured
+
+
+def measure_table(table, manual_widths=None):
+    """Build the layout model of the table: each row measured by
+    ``measure_row``, reflowed first if ``manual_widths`` is given.
+
+    """
+    if manual_widths:
+        return [measure_row(reflow_row_contents(row, manual_widths))
+                for row in table]
+    return [measure_row(row) for row in table]
+
+
+def get_column_widths(measured_table):
     widths = []
-    for row in table:
+    for row in measured_table:
         num_fields = len(row)
         # dynamically grow
         if num_fields >= len(widths):
             widths.extend([0] * (num_fields - len(widths)))
         for i in range(num_fields):
-            field_text = row[i]
-            field_width = get_field_width(field_text)
+            field_width = get_field_width(row[i])
             widths[i] = max(widths[i], field_width)
     return widths
 
@@ -323,20 +521,11 @@ def get_column_widths_from_border_spec(slice):
 
 def pad_fields(row, widths):
     """Pads fields of the given row, so each field lines up nicely with the
-    others.
+    others. The row is a list of ``(text, width)`` tuples, already measured.
 
     """
-    wgaps = [wcwidth.wcswidth(c) - len(c) for c in row]
-    widths = [w-wgaps[i] for i, w in enumerate(widths)]
-    widths = [(' %-' + str(w) + 's ') for w in widths]
-
-    # Pad all fields using the calculated widths
-    new_row = []
-    for i in range(len(row)):
-        col = row[i]
-        col = widths[i] % col.strip()
-        new_row.append(col)
-    return new_row
+    return [' %s%s ' % (text, ' ' * (widths[i] - width))
+            for i, (text, width) in enumerate(row)]
 
 
 def reflow_row_contents(row, widths):
@@ -351,8 +540,9 @@ def draw_table(indent, table, manual_widths=None):
     if table == []:
         return []
 
+    measured_table = measure_table(table, manual_widths)
     if manual_widths is None:
-        col_widths = get_column_widths(table)
+        col_widths = get_column_widths(measured_table)
     else:
         col_widths = manual_widths
 
@@ -363,11 +553,7 @@ def draw_table(indent, table, manual_widths=None):
 
     output = [indent + normal_line]
     first = True
-    for row in table:
-
-        if manual_widths:
-            row = reflow_row_contents(row, manual_widths)
-
+    for row in measured_table:
         row_lines = split_row_into_lines(row)
 
         # draw the lines (num_lines) for this row
@@ -0,0 +1,197 @@
+"""
+The conversion tools that can be run: where their executables are, and
+their versions, looked up once for a given ``command_path``.
+"""
+
+import os
+import sys
+import json
+import threading
+import subprocess
+
+# the tools known, by name. {executable}, {input} and {output} in the
+# commands are replaced. A tool with a stream_command reads the document
+# (in UTF-8) from its stdin instead of a file, and writes to its stdout
+# if stream_output is true.
+TOOLS = {
+    'pandoc': {'executables': ['pandoc'],
+               'formats': ['html', 'pdf', 'odt', 'docx'],
+               'command': ['{executable}', '{input}', '-o', '{output}'],
+               'stream_command': ['{executable}', '-f', 'rst', '-o', '{output}']},
+    'rst2pdf': {'executables': ['rst2pdf'],
+                'formats': ['pdf'],
+                'command': ['{executable}', '{input}', '-o', '{output}']},
+    'rst2html': {'executables': ['rst2html.py', 'rst2html'],
+                 'formats': ['html'],
+                 'command': ['{executable}', '{input}', '{output}'],
+                 'stream_command': ['{executable}', '--input-encoding=utf-8'],
+                 'stream_output': True},
+    'rst2odt': {'executables': ['rst2odt.py', 'rst2odt'],
+                'formats': ['odt'],
+                'command': ['{executable}', '{input}', '{output}']},
+}
+
+# seconds to wait for a tool to tell its version
+VERSION_TIMEOUT = 5
+
+
+def kill(process):
+    """stops a process, if it's still running"""
+    try:
+        if process.poll() is None:
+            process.kill()
+    except OSError:
+        # it finished in the meantime
+        pass
+
+
+def run_with_timeout(command, timeout, cwd=None, env=None, data=None,
+                     stdout=subprocess.PIPE, started=None, expired=None):
+    """
+    runs a command, with the data (bytes) written to its stdin, and
+    returns its (returncode, stdout, stderr) once it ends. It's killed
+    after timeout seconds: expired, if given, is called instead. started,
+    if given, is called with the process as soon as it runs. The errors
+    starting it are raised.
+    """
+    process = subprocess.Popen(
+        command, cwd=cwd, env=env, shell=sys.platform == "win32",
+        stdin=subprocess.PIPE if data is not None else None,
+        stdout=stdout, stderr=subprocess.PIPE)
+    if started is not None:
+        started(process)
+    timer = threading.Timer(timeout, expired or (lambda: kill(process)))
+    timer.start()
+    try:
+        # reading both pipes until the end, so the tool never blocks
+        output, errors = process.communicate(data)
+    finally:
+        timer.cancel()
+    return process.returncode, output, errors
+
+
+def find_executable(name, path):
+    """returns the full path of the executable in the path, or None"""
+    extensions = ['']
+    if sys.platform == "win32":
+        extensions += os.environ.get('PATHEXT', '.EXE;.BAT;.CMD').lower().split(';')
+    for directory in path.split(os.pathsep):
+        for extension in extensions:
+            candidate = os.path.join(directory, name + extension)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return candidate
+    return None
+
+
+class Tool(object):
+    """a tool found, with its version (the first line it prints for
+       ``--version``), empty until probed"""
+
+    def __init__(self, name, executable, formats, command, env,
+                 stream_command=None, stream_output=False):
+        self.name = name
+        self.executable = executable
+        self.formats = formats
+        self.command = command
+        self.env = env
+        self.stream_command = stream_command
+        self.stream_output = stream_output
+        self.version = ''
+
+    def probe_version(self):
+        """runs the tool to know its version. It can take seconds: not
+           to be called from the main thread"""
+        try:
+            returncode, stdout, stderr = run_with_timeout(
+                [self.executable, '--version'], VERSION_TIMEOUT, env=self.env)
+        except Exception:
+            return
+        lines = (stdout or stderr).decode('utf-8', 'replace').strip().splitlines()
+        if lines:
+            self.version = lines[0].strip()
+
+    def get_command(self, infile, outfile):
+        return [part.format(executable=self.executable, input=infile, output=outfile)
+                for part in self.command]
+
+    def get_stream_command(self, outfile):
+        """returns the command that reads the document from stdin, or
+           None if the tool needs a file"""
+        if not self.stream_command:
+            return None
+        return [part.format(executable=self.executable, output=outfile)
+                for part in self.stream_command]
+
+
+class Toolchain(object):
+    """
+    the tools found in the PATH plus the command_path. extra_tools are
+    added to the known TOOLS, with the same structure.
+    """
+    def __init__(self, command_path=(), extra_tools=None):
+        path = []
+        for bit in os.environ.get('PATH', '').split(os.pathsep) + list(command_path):
+            if bit and bit not in path:
+                path.append(bit)
+        self.path = os.pathsep.join(path)
+        # the environment to run the tools, so they find their own tools
+        self.env = dict(os.environ, PATH=self.path)
+        self.specs = dict(TOOLS)
+        self.specs.update(extra_tools or {})
+        self.tools = {}
+        self.lock = threading.Lock()
+        self.probing = False
+
+    def get(self, name):
+        """returns the Tool of the given name, or None if not found"""
+        with self.lock:
+            if name not in self.tools:
+                spec = self.specs.get(name) or {}
+                self.tools[name] = None
+                for executable in spec.get('executables', [name]):
+                    found = find_executable(executable, self.path)
+                    if found:
+                        self.tools[name] = Tool(
+                            name, found, spec.get('formats', []),
+                            spec.get('command', ['{executable}', '{input}', '{output}']),
+                            self.env, spec.get('stream_command'),
+                            spec.get('stream_output', False))
+                        break
+            return self.tools[name]
+
+    def probe_versions(self):
+        """asks the versions of the tools found in a background thread,
+           once"""
+        with self.lock:
+            if self.probing:
+                return
+            self.probing = True
+
+        def probe():
+            for name in sorted(self.specs):
+                tool = self.get(name)
+                if tool is not None:
+                    tool.probe_version()
+        thread = threading.Thread(target=probe)
+        thread.daemon = True
+        thread.start()
+
+    def targets(self):
+        """returns the '<format> (<tool>)' targets of the tools known"""
+        return ['%s (%s)' % (target, name)
+                for name in sorted(self.specs)
+                for target in self.specs[name].get('formats', [])]
+
+
+# the Toolchain of the last command_path and extra tools asked for
+_cache = {}
+
+
+def get_toolchain(command_path=(), extra_tools=None):
+    """returns the Toolchain for the settings, made again only if they
+       changed since the last time"""
+    key = json.dumps([list(command_path), extra_tools or {}], sort_keys=True)
+    if key not in _cache:
+        _cache.clear()
+        _cache[key] = Toolchain(command_path, extra_tools)
+    return _cache[key]
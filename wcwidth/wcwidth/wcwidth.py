@@ -70,9 +70,48 @@ Latest version: http://www.cl.cam.ac.uk/~mgk25/ucs/wcwidth.c
 """
 
 from __future__ import division
+import re
+
 from .table_wide import WIDE_EASTASIAN
 from .table_comb import NONZERO_COMBINING
 
+#: Characters whose code point is looked up in the page table are stored as
+#: one of these codes.
+_CONTROL, _ZERO, _NARROW, _WIDE, _COMBINING = range(5)
+
+#: code -> value returned by ``wcwidth()``
+_CHAR_WIDTH = (-1, 0, 1, 2, -1)
+
+#: code -> contribution to ``wcswidth()`` (``None`` means non printable)
+_STRING_WIDTH = (None, 0, 1, 2, 0)
+
+#: zero width characters, hand picked (see ``wcwidth()`` docstring)
+_ZERO_WIDTH = (
+    (0x0000, 0x0000,),
+    (0x034f, 0x034f,),
+    (0x200b, 0x200f,),
+    (0x2028, 0x202e,),
+    (0x2060, 0x2063,),
+)
+
+#: C0/C1 control characters
+_CONTROL_CHARS = (
+    (0x0001, 0x001f,),
+    (0x007f, 0x009f,),
+)
+
+_PAGE_BITS = 8
+_PAGE_SIZE = 1 << _PAGE_BITS
+_PAGE_MASK = _PAGE_SIZE - 1
+_MAX_UCS = 0x10ffff
+
+#: Printable ASCII and Latin-1 only: every character is one cell wide.
+_NARROW_RE = re.compile(r'[\x20-\x7e\xa0-\xff]*\Z')
+
+#: Bound of the whole-string width cache.
+CACHE_SIZE = 4096
+_cache = {}
+
 
 def _bisearch(ucs, table):
     """
@@ -102,6 +141,57 @@ def _bisearch(ucs, table):
     return 0
 
 
+def _build_page_table():
+    """
+    Build the two-level lookup table of every unicode code point.
+
+    The code point range is split in pages of ``_PAGE_SIZE`` characters.
+    Each page is a ``bytearray`` holding the width code of its
+    characters. Pages with the same contents (the vast majority, which
+    are entirely narrow) are shared, so the whole table needs only a
+    few dozen distinct pages.
+
+    :rtype: tuple
+    :returns: a tuple of pages, indexed by ``ucs >> _PAGE_BITS``.
+    """
+    pages = {}
+
+    def fill(table, code):
+        for start, end in table:
+            end = min(end, _MAX_UCS)
+            while start <= end:
+                number = start >> _PAGE_BITS
+                page_end = min(end, (number << _PAGE_BITS) | _PAGE_MASK)
+                page = pages.get(number)
+                if page is None:
+                    page = pages[number] = bytearray([_NARROW]) * _PAGE_SIZE
+                low = start & _PAGE_MASK
+                high = (page_end & _PAGE_MASK) + 1
+                page[low:high] = bytearray([code]) * (high - low)
+                start = page_end + 1
+
+    # same precedence than the checks in the original wcwidth():
+    # the last fill wins.
+    fill(WIDE_EASTASIAN, _WIDE)
+    fill(NONZERO_COMBINING, _COMBINING)
+    fill(_CONTROL_CHARS, _CONTROL)
+    fill(_ZERO_WIDTH, _ZERO)
+
+    shared = {}
+    narrow = bytearray([_NARROW]) * _PAGE_SIZE
+    table = []
+    for number in range((_MAX_UCS >> _PAGE_BITS) + 1):
+        page = pages.get(number)
+        if page is None:
+            table.append(narrow)
+        else:
+            table.append(shared.setdefault(bytes(page), page))
+    return tuple(table)
+
+
+_PAGES = _build_page_table()
+
+
 def wcwidth(wc):
     r"""
     Given one unicode character, return its printable length on a terminal.
@@ -157,29 +247,22 @@ def wcwidth(wc):
     # pylint: disable=C0103
     #         Invalid argument name "wc"
     ucs = ord(wc)
+    return _CHAR_WIDTH[_PAGES[ucs >> _PAGE_BITS][ucs & _PAGE_MASK]]
 
-    # NOTE: created by hand, there isn't anything identifiable other than
-    # general Cf category code to identify these, and some characters in Cf
-    # category code are of non-zero width.
-    if (0 == ucs or
-            0x034F == ucs or
-            0x200B <= ucs <= 0x200F or
-            0x2028 == ucs or
-            0x2029 == ucs or
-            0x202A <= ucs <= 0x202E or
-            0x2060 <= ucs <= 0x2063):
-        return 0
-
-    # C0/C1 control characters
-    if ucs < 32 or 0x07F <= ucs < 0x0A0:
-        return -1
 
-    # combining characters have indeterminate effects unless
-    # combined with additional characters.
-    if _bisearch(ucs, NONZERO_COMBINING):
-        return -1
-
-    return 1 + _bisearch(ucs, WIDE_EASTASIAN)
+def _wcswidth(pwcs):
+    """
+    Width of the whole string ``pwcs``, computed from the page table.
+    """
+    pages = _PAGES
+    width = 0
+    for char in pwcs:
+        ucs = ord(char)
+        wcw = _STRING_WIDTH[pages[ucs >> _PAGE_BITS][ucs & _PAGE_MASK]]
+        if wcw is None:
+            return -1
+        width += wcw
+    return width
 
 
 def wcswidth(pwcs, n=None):
@@ -189,20 +272,22 @@ def wcswidth(pwcs, n=None):
     Return the width in character cells of the first ``n`` unicode string pwcs,
     or -1 if a non-printable character is encountered. When ``n`` is None
     (default), return the length of the entire string.
+
+    Strings made only of printable ASCII/Latin-1 characters are measured
+    by their length. Any other string is looked up character by character
+    in the page table, and its width is kept in a bounded cache.
     """
     # pylint: disable=C0103
     #         Invalid argument name "n"
-
-    end = len(pwcs) if n is None else n
-    idx = slice(0, end)
-    width = 0
-    for char in pwcs[idx]:
-        wcw = wcwidth(char)
-        if wcw < 0:
-            ucs = ord(char)
-            if _bisearch(ucs, NONZERO_COMBINING):
-                continue
-            return -1
-        else:
-            width += wcw
+    if n is not None:
+        pwcs = pwcs[:n]
+    if _NARROW_RE.match(pwcs):
+        return len(pwcs)
+    try:
+        return _cache[pwcs]
+    except KeyError:
+        pass
+    if len(_cache) >= CACHE_SIZE:
+        _cache.clear()
+    width = _cache[pwcs] = _wcswidth(pwcs)
     return width